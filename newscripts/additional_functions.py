@@ -2,9 +2,12 @@ from dictionaries import CRC32_KEY
 import zlib
 
 # Get hash value from string (file path. The hash value can be obtained from the name of the entry files (obtained from BigPC Unpacker))
+def get_path_hash(file_path_value: str) -> int:
+    return zlib.crc32(file_path_value.lower().encode()) & 0xffffffff
+
 def file_path_hash(file_path_value: str): 
     file_path_value = file_path_value.lower()
-    print('{} => 0x{:08x}'.format(file_path_value, zlib.crc32(file_path_value.encode()) & 0xffffffff))
+    print('{} => 0x{:08x}'.format(file_path_value, get_path_hash(file_path_value)))
 
 # Same to previous
 def get_crc_from_string(string_value: str) -> int:
@@ -1,13 +1,31 @@
 import io
+from collections import deque
+from functools import partial
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import xml.etree.ElementTree as ET
+import argparse
+import hashlib
+import json
+import multiprocessing, multiprocessing.util
+import sqlite3
 import struct
+import shutil
 import sys, os
+import time
+from typing import Any, Callable, Iterable, Iterator
 
 import zlib
 
+from bigpc3_unpack import BigArchive, getEndianness
+
 XML_DATA_FILE: str = "entries.xml"
+JSONL_DATA_FILE: str = "entries.jsonl"
 ENDIANNESS: str = ""
 DIRECTORY: str = ""
+EXECUTOR: ThreadPoolExecutor | None = None # compresses chunks with --jobs
+REFERENCE: BigArchive | None = None # original archive, its segments are copied for unchanged entries
+COMPRESS_WINDOW: int = 1 # number of chunks compressed ahead of the writer
+CACHE: "ChunkCache | None" = None # compressed chunks of the previous builds, with --cache
 
 # XML FUNCTIONS
 
@@ -21,13 +39,217 @@ def get_tree_table(root: ET.Element) -> ET.Element:
 def get_tree_segments(root: ET.Element) -> ET.Element:
 	return root.find("segments") #type: ignore
 
+# JSON LINES FUNCTIONS
+
+def record_to_elements(record: dict[str, Any]) -> tuple[ET.Element, ET.Element]: # builds the row and segment of a single entry, as they are in entries.xml
+	row = ET.Element("row", attrib={"hash": record["hash"], "offset": record["offset"]})
+	ET.SubElement(row, "decompressed_block1_size").text = str(record["decompressed_block1_size"])
+	ET.SubElement(row, "decompressed_block2_size").text = str(record["decompressed_block2_size"])
+	ET.SubElement(row, "compressed_size").text = str(record["compressed_size"])
+
+	segment = ET.Element("segment", attrib={"case": str(record["case"]), "hash": record["hash"]})
+	if "type" in record:
+		segment.attrib.update({key: str(record[key]) for key in ("type", "u0", "u1", "u2", "u3")})
+		for uobj in record["objects"]:
+			ET.SubElement(segment, "object").text = str(uobj)
+		for chunk in record["chunks"]:
+			ET.SubElement(segment, "chunk", attrib={key: str(value) for key, value in chunk.items()})
+
+	return row, segment
+
+def read_jsonl_records(file_directory: str) -> Iterator[tuple[ET.Element, ET.Element]]:
+	with open(file_directory + JSONL_DATA_FILE, "r") as file:
+		file.readline() # header
+		for line in file:
+			record = json.loads(line)
+			if (record["case"] == 0):
+				raise Exception("Case 0 not supported for now")
+			yield record_to_elements(record)
+
+def get_manifest(file_directory: str, manifest_format: str | None) -> tuple[dict[str, Any], Iterator[tuple[ET.Element, ET.Element]]]:
+	if manifest_format is None: # the newer manifest is used, the unpacker does not remove the other one
+		manifests: list[tuple[float, str]] = [(os.path.getmtime(file_directory + data_file), data_format) for data_format, data_file in (("jsonl", JSONL_DATA_FILE), ("xml", XML_DATA_FILE)) if os.path.exists(file_directory + data_file)]
+		manifest_format = max(manifests, key=lambda manifest: manifest[0])[1] if manifests else "xml" # entries.jsonl if both have the same time
+
+	if manifest_format == "jsonl":
+		with open(file_directory + JSONL_DATA_FILE, "r") as file:
+			header: dict[str, Any] = json.loads(file.readline())
+		if (header["archive_type"] != 3):
+			raise Exception("Unsupported archive")
+		return header, read_jsonl_records(file_directory)
+
+	root = get_tree_root(file_directory)
+	row_table = get_tree_table(root)
+	segment_table = get_tree_segments(root)
+
+	check_archive_type(row_table, segment_table)
+
+	header = {"endianness": root.get("endianness"), "file_name": root.get("file_name") or ""}
+	return header, zip(row_table.findall("row"), segment_table.findall("segment"))
+
 # COMPRESSOR
 
-def pack_with_zlib(data: bytes) -> tuple[bytes, int]:
-	data = zlib.compress(data, level = 9, wbits = -15)
+try:
+	import deflate # libdeflate
+except ImportError:
+	deflate = None
+
+try:
+	from isal import isal_zlib # Intel ISA-L, levels 0-3
+except ImportError:
+	isal_zlib = None
+
+try:
+	import zopfli # the smallest output, but very slow
+except ImportError:
+	zopfli = None
+
+def pack_with_zlib(data: bytes, level: int = 9, mem_level: int = zlib.DEF_MEM_LEVEL, strategy: int = zlib.Z_DEFAULT_STRATEGY) -> tuple[bytes, int]:
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -15, mem_level, strategy)
+	data = compressor.compress(data) + compressor.flush()
+	data_size: int = len(data)
+	return data, data_size
+
+def pack_with_libdeflate(data: bytes, level: int = 12) -> tuple[bytes, int]:
+	data = deflate.deflate_compress(data, level) #type: ignore
+	data_size: int = len(data)
+	return data, data_size
+
+def pack_with_isal(data: bytes, level: int = 3) -> tuple[bytes, int]:
+	data = isal_zlib.compress(data, level, wbits = -15) #type: ignore
+	data_size: int = len(data)
+	return data, data_size
+
+def pack_with_zopfli(data: bytes) -> tuple[bytes, int]:
+	compressor = zopfli.ZopfliCompressor(zopfli.ZOPFLI_FORMAT_DEFLATE) #type: ignore
+	data = compressor.compress(data) + compressor.flush()
 	data_size: int = len(data)
 	return data, data_size
 
+def get_codecs() -> dict[str, Callable[[bytes], tuple[bytes, int]]]: # every codec writes raw deflate, only installed backends are listed
+	codecs: dict[str, Callable[[bytes], tuple[bytes, int]]] = {f"zlib-{level}": partial(pack_with_zlib, level = level) for level in range(1, 10)}
+	codecs["zlib-9-mem9"] = partial(pack_with_zlib, level = 9, mem_level = 9)
+	codecs["zlib-9-filtered"] = partial(pack_with_zlib, level = 9, mem_level = 9, strategy = zlib.Z_FILTERED)
+	codecs["zlib-rle"] = partial(pack_with_zlib, level = 1, strategy = zlib.Z_RLE)
+
+	if deflate is not None:
+		codecs.update({f"libdeflate-{level}": partial(pack_with_libdeflate, level = level) for level in (1, 6, 9, 12)})
+	if isal_zlib is not None:
+		codecs.update({f"isal-{level}": partial(pack_with_isal, level = level) for level in range(0, 4)})
+	if zopfli is not None:
+		codecs["zopfli"] = pack_with_zopfli
+
+	return codecs
+
+CODECS: dict[str, Callable[[bytes], tuple[bytes, int]]] = get_codecs()
+DEFAULT_CODEC: str = "zlib-9"
+CODEC: Callable[[bytes], tuple[bytes, int]] = CODECS[DEFAULT_CODEC]
+
+def benchmark_codecs(directory_path: str, codec_names: list[str], sample_size: int = 64 << 20) -> bool: # compresses the hash-named files of the directory in 128 KB chunks, as the packer does, up to sample_size bytes
+	if not directory_path.endswith(os.sep):
+		directory_path += os.sep
+
+	chunks: list[bytes] = list() # the sample is kept in memory, so the disk is not measured
+	input_size: int = 0
+	for file_name in entry_file_names(directory_path):
+		with open(directory_path + file_name, "rb") as file_to_read:
+			while input_size < sample_size and (local_decompressed_data := file_to_read.read(min(2**17, sample_size - input_size))):
+				chunks.append(local_decompressed_data)
+				input_size += len(local_decompressed_data)
+		if input_size >= sample_size:
+			break
+
+	if not input_size:
+		print("No entries to compress")
+		return False
+
+	print(f"{len(chunks)} chunks, {input_size} bytes")
+	print(f"{'codec':<18}{'size':>12}{'ratio':>9}{'MB/s':>10}")
+	for codec_name in codec_names or CODECS.keys():
+		codec = CODECS[codec_name]
+		start_time: float = time.perf_counter()
+		output_size: int = sum(codec(data)[1] for data in chunks)
+		elapsed_time: float = time.perf_counter() - start_time
+		print(f"{codec_name:<18}{output_size:>12}{output_size / input_size:>9.2%}{input_size / elapsed_time / 2**20:>10.1f}")
+
+	return True
+
+# COMPRESSION CACHE
+
+class ChunkCache: # compressed chunks by digest of the decompressed data and codec, least recently used are evicted
+	def __init__(self, path: str, codec_name: str, max_size: int):
+		self.codec_name = codec_name
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+
+		self.connection = sqlite3.connect(path)
+		self.connection.execute("CREATE TABLE IF NOT EXISTS chunks (digest BLOB, codec TEXT, data BLOB, size INTEGER, used INTEGER, PRIMARY KEY (digest, codec))")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS chunks_used ON chunks (used)")
+		self.total_size, self.clock = self.connection.execute("SELECT COALESCE(SUM(size), 0), COALESCE(MAX(used), 0) FROM chunks").fetchone()
+
+	@staticmethod
+	def digest(data: bytes) -> bytes:
+		return hashlib.blake2b(data, digest_size=16).digest()
+
+	def get(self, digest: bytes) -> bytes | None:
+		row = self.connection.execute("SELECT data FROM chunks WHERE digest = ? AND codec = ?", (digest, self.codec_name)).fetchone()
+		if row is None:
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		self.clock += 1
+		self.connection.execute("UPDATE chunks SET used = ? WHERE digest = ? AND codec = ?", (self.clock, digest, self.codec_name))
+		return row[0]
+
+	def put(self, digest: bytes, data: bytes) -> None:
+		self.clock += 1
+		cursor = self.connection.execute("INSERT OR IGNORE INTO chunks VALUES (?, ?, ?, ?, ?)", (digest, self.codec_name, data, len(data), self.clock))
+		if cursor.rowcount == 1: # already stored chunks are ignored
+			self.total_size += len(data)
+		if self.total_size > self.max_size:
+			self.evict()
+
+	def evict(self) -> None:
+		while self.total_size > self.max_size:
+			rows = self.connection.execute("SELECT digest, codec, size FROM chunks ORDER BY used LIMIT 64").fetchall()
+			if not rows:
+				self.total_size = 0
+				break
+			self.connection.executemany("DELETE FROM chunks WHERE digest = ? AND codec = ?", [(digest, codec) for digest, codec, _size in rows])
+			self.total_size -= sum(size for _digest, _codec, size in rows)
+
+	def close(self) -> None:
+		self.evict() # the limit could be lowered since the last build
+		self.connection.commit()
+		self.connection.close()
+		print(f"Chunk cache: {self.hits} hits, {self.misses} misses")
+
+def start_compression(jobs: int, codec_name: str, cache_path: str | None, cache_size: int) -> None:
+	global EXECUTOR
+	global COMPRESS_WINDOW
+	global CODEC
+	global CACHE
+
+	CODEC = CODECS[codec_name]
+	if jobs > 1:
+		EXECUTOR = ThreadPoolExecutor(jobs) # zlib releases the GIL while compressing
+		COMPRESS_WINDOW = jobs * 2
+	if cache_path is not None:
+		CACHE = ChunkCache(cache_path, codec_name, cache_size)
+
+def stop_compression() -> None:
+	global EXECUTOR
+	global CACHE
+
+	if EXECUTOR is not None:
+		EXECUTOR.shutdown()
+		EXECUTOR = None
+	if CACHE is not None:
+		CACHE.close()
+		CACHE = None
+
 # DATA FUNCTIONS
 
 def check_archive_type(table: ET.Element, segments: ET.Element) -> None:
@@ -39,6 +261,20 @@ def check_archive_type(table: ET.Element, segments: ET.Element) -> None:
 		raise Exception("Case 0 not supported for now")
 	return
 
+def entry_file_names(directory_path: str) -> list[str]: # hash-named files of the directory (f.e. 0x5669ff3c), other 0x files are reported and skipped
+	file_names: list[str] = list()
+	for file_name in sorted(os.listdir(directory_path)):
+		if not file_name.startswith("0x") or not os.path.isfile(directory_path + file_name):
+			continue
+		try:
+			if int(file_name, 16) >> 32:
+				raise ValueError
+		except ValueError: # f.e. 0x00000010.atb from fileext.py
+			print(f"{file_name} is not a hash-named file, skipped")
+			continue
+		file_names.append(file_name)
+	return file_names
+
 def get_header_size(data: bytes, first_block_size: int) -> int: # for 2-blocked arhives
 	try:
 		magic: bytes = struct.unpack(ENDIANNESS + "4s", data[0:4])[0]
@@ -77,29 +313,26 @@ def single_segment_handler(row: ET.Element, segment: ET.Element, file_to_write:
 		multiblocked_segment = True
 		
 	decompressed_main_block_size = 0
-	data_to_write = b""
-	with open(DIRECTORY + (row.get("hash") or ""), "rb") as file_to_read:
+	current_offset_position = file_to_write.tell()
+	with open(DIRECTORY + (row.get("hash") or ""), "rb") as file_to_read: # the file is copied to the archive without keeping it in memory
 		if multiblocked_segment:
 			block1_size = get_header_size(file_to_read.read(0x10), block1_size) # trM has size of blocks
 			file_to_read.seek(0)
 
 			print(f"{block1_size}")
 
-			data_to_write += file_to_read.read(block1_size)
+			file_to_write.write(file_to_read.read(block1_size))
 		
 		decompressed_main_block_size = file_to_read.tell()
-		data_to_write += file_to_read.read()
+		shutil.copyfileobj(file_to_read, file_to_write)
 		decompressed_main_block_size = file_to_read.tell() - decompressed_main_block_size
 		offset: int = decompressed_main_block_size % 16
 		if offset:
 			print(row.get("hash"), "is offset", offset)
-			data_to_write += (b"X" * (16 - offset))
+			file_to_write.write(b"X" * (16 - offset))
 			decompressed_main_block_size += (16 - offset)
 		# print(f"{decompressed_main_block_size}")
 
-	current_offset_position = file_to_write.tell()
-	file_to_write.write(data_to_write)
-
 	table_row_dict = {
 		"hash": int(row.get("hash") or "", 16),
 		"offset": current_offset_position >> 4,
@@ -110,188 +343,565 @@ def single_segment_handler(row: ET.Element, segment: ET.Element, file_to_write:
 
 	return table_row_dict
 
+def compress_chunk(data: bytes) -> tuple[bytes, int]:
+	return CODEC(data)
+
+def prepare_chunk(data: bytes, flags: int) -> bytes: # chunks with flag 0x00 are stored without compression
+	if flags & 0x10:
+		data, _compressed_data_size = compress_chunk(data)
+	return data
+
+def finish_chunk(digest: bytes | None, result: Future[bytes] | bytes) -> bytes:
+	if isinstance(result, Future):
+		result = result.result()
+	if digest is not None: # compressed now, stored for the next builds
+		CACHE.put(digest, result) #type: ignore
+	return result
+
+def compress_chunks(chunks: Iterable[tuple[bytes, int]]) -> Iterator[bytes]: # results are returned in the order of the chunks
+	pending: deque[tuple[bytes | None, Future[bytes] | bytes]] = deque()
+	pending_digests: dict[bytes, Future[bytes] | bytes] = dict() # chunks in the window are not in the cache yet, repeated ones are compressed once
+
+	def next_result() -> bytes:
+		digest, result = pending.popleft()
+		if digest is not None:
+			del pending_digests[digest]
+		return finish_chunk(digest, result)
+
+	for data, flags in chunks:
+		digest: bytes | None = None
+		result: Future[bytes] | bytes | None = None
+		if flags & 0x10 and CACHE is not None:
+			digest = CACHE.digest(data)
+			result = pending_digests.get(digest)
+			if result is None:
+				result = CACHE.get(digest)
+			else:
+				CACHE.hits += 1
+		if result is not None:
+			digest = None
+		elif EXECUTOR is not None:
+			result = EXECUTOR.submit(prepare_chunk, data, flags)
+		else:
+			result = prepare_chunk(data, flags)
+
+		pending.append((digest, result))
+		if digest is not None:
+			pending_digests[digest] = result
+		if len(pending) > COMPRESS_WINDOW: # keeps only a few chunks in memory
+			yield next_result()
+	while pending:
+		yield next_result()
+
+def chunk_layout(row: ET.Element, file_to_read: io.BufferedReader, decompressed_file_size: int) -> list[tuple[int, int]]: # size and flags of every chunk, known before compression
+	if (decompressed_file_size < 100): # TODO: find real uncompressed value
+		return [(decompressed_file_size, 0x00)]
+
+	layout: list[tuple[int, int]] = list()
+	flag_value = 0x10
+	position = 0
+
+	if row.find("decompressed_block2_size").text != "0":
+		flag_value = 0x11
+		block_size = int(row.find("decompressed_block1_size").text)
+		block_size = get_header_size(file_to_read.read(0x10), block_size) # trM has size of blocks
+		file_to_read.seek(0)
+
+		position = min(block_size, decompressed_file_size)
+		layout.append((position, 0x10))
+
+	while position - decompressed_file_size:
+		local_size = min(2**17, decompressed_file_size - position)
+		layout.append((local_size, flag_value))
+		position += local_size
+
+	return layout
+
+def read_chunks(file_to_read: io.BufferedReader, layout: list[tuple[int, int]]) -> Iterator[tuple[bytes, int]]:
+	for local_size, flags in layout:
+		yield file_to_read.read(local_size), flags
+
 # in row compressed size = full value of segment (include seg header + chunks headers + chunk data). size1-size2 = only decompressed data size
 def multi_segment_handler(row: ET.Element, segment: ET.Element, file_to_write: io.BufferedWriter): # in main has many chunks
-	multiblocked_segment = False 
 	block1_size = None
 	decompressed_main_block_size = 0
 
-	flag_value = 0x10
-
 	magic_value = "sges"    # 4 bytes
 	segment_type = 7        # 2 bytes
-	num_chunks = 0          # 2 bytes
 	object_count = 0        # 4 bytes
 
 	if segment.get("u0") != "0":
 		raise Exception("Objects not supported for now")
 
 	if row.find("decompressed_block2_size").text != "0":
-		multiblocked_segment = True
 		block1_size = int(row.find("decompressed_block1_size").text)
-		
-	data_to_write = b""
+
 	with open(DIRECTORY + row.get("hash"), "rb") as file_to_read: # reads ONLY hash-named files
 		file_to_read.seek(0, 2)  
 		decompressed_file_size = file_to_read.tell()  # get decompressed file size
 		file_to_read.seek(0)
 
-		segment_info_list = list()
+		layout = chunk_layout(row, file_to_read, decompressed_file_size)
+		num_chunks = len(layout)
+		decompressed_main_block_size = sum(local_size for local_size, flags in layout[1 if block1_size and decompressed_file_size >= 100 else 0:])
 
-		while True: # chunk writer
-			if (decompressed_file_size < 100): # TODO: find real uncompressed value
-				local_decompressed_data = file_to_read.read()
-				decompressed_data_size = len(local_decompressed_data)
-				decompressed_main_block_size += decompressed_data_size
+		# the header size depends only on the number of chunks, its space is reserved and filled after the chunks are written
+		header_size = struct.calcsize(ENDIANNESS + "4sHHI") + struct.calcsize(ENDIANNESS + "H2B") * num_chunks
+		header_size += -header_size % 0x10
+		segment_header = bytearray(header_size)
+		struct.pack_into(ENDIANNESS + "4sHHI", segment_header, 0, magic_value.encode(), segment_type, num_chunks, object_count)
 
-				chunk_data, zero_count = data_to_chunk_pattern(local_decompressed_data)
-				data_to_write += chunk_data
-				decompressed_data_size += zero_count
+		current_offset_position = file_to_write.tell()
+		file_to_write.write(segment_header)
+
+		header_position = struct.calcsize(ENDIANNESS + "4sHHI")
+		for (_local_size, flags), chunk_data in zip(layout, compress_chunks(read_chunks(file_to_read, layout))): # chunk writer
+			file_to_write.write(chunk_data)
+			padding_size = -len(chunk_data) % 0x10
+			if padding_size:
+				file_to_write.write(b"\x00" * padding_size)
+
+			chunk_data_size, size_coefficient = get_buffer_rounds(len(chunk_data) + padding_size)
+			struct.pack_into(ENDIANNESS + "H2B", segment_header, header_position, chunk_data_size, flags, size_coefficient)
+			header_position += struct.calcsize(ENDIANNESS + "H2B")
+
+		segment_end_position = file_to_write.tell()
+		file_to_write.seek(current_offset_position) # backpatch the chunk table
+		file_to_write.write(segment_header)
+		file_to_write.seek(segment_end_position)
+		
+		table_row_dict = {
+			"hash": int(row.get("hash"), 16),
+			"offset": current_offset_position >> 4,
+			"block1_size": block1_size if block1_size else decompressed_main_block_size, # block1 is static
+			"block2_size": decompressed_main_block_size if block1_size else 0,
+			"compressed_size": segment_end_position - current_offset_position
+		}
 
-				decompressed_data_size, size_coefficient = get_buffer_rounds(decompressed_data_size) 
+	return table_row_dict
 
-				parameters_dict = {
-					"size": decompressed_data_size,
-					"flags": 0x00,
-					"size_coeff": size_coefficient
-				}
+def write_table(file_to_write: io.BufferedWriter, table_rows: list[dict[str, int]]):
+	entries_count: int = len(table_rows)
+	row_size: int = struct.calcsize(ENDIANNESS + "5I")
+	table_data = bytearray(8 + row_size * entries_count) # the whole table is filled in place
 
-				segment_info_list.append(parameters_dict)
+	struct.pack_into("<2I", table_data, 0, 3, entries_count) # Endianness static?
+	for row_index, entries_data in enumerate(table_rows):
+		hash_value, offset_value, block1_size, block2_size, compressed_size = entries_data.values()
+		struct.pack_into(ENDIANNESS + "5I", table_data, 8 + row_size * row_index, hash_value, offset_value, block1_size, block2_size, compressed_size)
+	
+	table_start_position = file_to_write.tell()
+	file_to_write.write(table_data)
+
+	table_offset = file_to_write.tell() + 4 - table_start_position # integer for offset
+	file_to_write.write(struct.pack("<I", table_offset)) # write offset to the end
+
+# REFERENCE ARCHIVE
+
+def entry_parts(archive: BigArchive, entry: BigArchive.Entry) -> Iterator[bytes | memoryview]: # decompressed data of the entry, one chunk at a time
+	if not archive.isSegment(entry.offset):
+		size: int = archive.singleSize(entry)
+		for offset in range(0, size, 2**17):
+			yield archive.readAt(entry.offset + offset, min(2**17, size - offset))
+		return
+
+	for chunk in archive.readSegment(entry.offset).chunks:
+		yield archive.inflateChunk(chunk, archive.readChunk(entry, chunk))
+
+def entry_matches(archive: BigArchive, entry: BigArchive.Entry, file_path: str) -> bool: # compares the file with the decompressed entry chunk by chunk
+	entry_size: int = entry.size1 + entry.size2 if archive.isSegment(entry.offset) else archive.singleSize(entry)
+	padding_size: int = entry_size - os.path.getsize(file_path)
+	if padding_size < 0 or padding_size >= 0x10 or padding_size and archive.isSegment(entry.offset): # single entries are padded with X to 16 bytes
+		return False
+
+	with open(file_path, "rb") as file_to_read:
+		for local_decompressed_data in entry_parts(archive, entry):
+			source_data: bytes = file_to_read.read(len(local_decompressed_data))
+			if source_data != local_decompressed_data[:len(source_data)] or local_decompressed_data[len(source_data):] != b"X" * (len(local_decompressed_data) - len(source_data)):
+				return False
+		return file_to_read.read(1) == b""
+
+def reference_segment_handler(row: ET.Element, segment: ET.Element, file_to_write: io.BufferedWriter) -> dict[str, int] | None: # copies the original segment if the file is unchanged
+	entry = REFERENCE.findEntry(int(row.get("hash"), 16)) #type: ignore
+	if entry is None or not REFERENCE.isSegment(entry.offset): #type: ignore
+		return None
+	if not entry_matches(REFERENCE, entry, DIRECTORY + row.get("hash")): #type: ignore
+		return None
 
-				num_chunks += 1
-				break
+	current_offset_position = file_to_write.tell()
+	file_to_write.write(REFERENCE.readAt(entry.offset, stored_size(REFERENCE, entry))) #type: ignore
+
+	return entry_table_row(entry, current_offset_position)
+
+# PATCH AND COMPACT
+
+def entry_table_row(entry: BigArchive.Entry, offset: int) -> dict[str, int]:
+	table_row_dict = {
+		"hash": entry.hash,
+		"offset": offset >> 4,
+		"block1_size": entry.size1,
+		"block2_size": entry.size2,
+		"compressed_size": entry.size3
+	}
 
-			if multiblocked_segment:
-				multiblocked_segment = False
-				flag_value = 0x11
-				block_size = int(row.find("decompressed_block1_size").text)
-				block_size = get_header_size(file_to_read.read(0x10), block_size) # trM has size of blocks
-				file_to_read.seek(0)
-				
-				local_decompressed_data = file_to_read.read(block_size)
-				decompressed_data_size = len(local_decompressed_data) # useless? 
-
-				local_compressed_data, compressed_data_size = pack_with_deflate(local_decompressed_data) if deflate_available else pack_with_zlib(local_decompressed_data)
-				chunk_data, zero_count = data_to_chunk_pattern(local_compressed_data)
-				data_to_write += chunk_data
-				compressed_data_size += zero_count 
-				compressed_data_size, size_coefficient = get_buffer_rounds(compressed_data_size) 
-
-				parameters_dict = {
-					"size": compressed_data_size,
-					"flags": 0x10,
-					"size_coeff": size_coefficient
-				}
-
-				segment_info_list.append(parameters_dict)
+	return table_row_dict
 
+def load_patch_state(archive_path: str, directory_path: str) -> dict[str, list[int]]: # size and mtime of the files that matched the archive after the last patch
+	try:
+		with open(archive_path + ".state.json", "r") as state_file:
+			state: dict[str, Any] = json.load(state_file)
+		archive_stat = os.stat(archive_path)
+		if state.get("archive") == [archive_stat.st_size, archive_stat.st_mtime_ns] and state.get("folder") == os.path.abspath(directory_path): # ignored once the archive was changed by something else
+			return state["files"]
+	except (OSError, ValueError, AttributeError, KeyError):
+		pass
+	return dict()
+
+def save_patch_state(archive_path: str, directory_path: str, file_state: dict[str, list[int]]) -> None:
+	archive_stat = os.stat(archive_path)
+	with open(archive_path + ".state.json", "w") as state_file:
+		json.dump({"archive": [archive_stat.st_size, archive_stat.st_mtime_ns], "folder": os.path.abspath(directory_path), "files": file_state}, state_file)
+
+def load_fingerprints(directory_path: str) -> dict[str, dict[str, Any]]: # written by bigpc3_unpack.py --incremental
+	try:
+		with open(directory_path + "fingerprints.json", "r") as fingerprints_file:
+			return json.load(fingerprints_file)
+	except (OSError, ValueError):
+		return dict()
+
+def file_unchanged(entry: BigArchive.Entry, file_name: str, file_size: int, file_mtime: int, known_files: dict[str, list[int]], fingerprints: dict[str, dict[str, Any]]) -> bool: # checks only the size and mtime, the data is not read
+	if known_files.get(file_name) == [file_size, file_mtime]:
+		return True
+
+	fingerprint = fingerprints.get(file_name)
+	return fingerprint is not None and [fingerprint.get(key) for key in ("offset", "size1", "size2", "size3", "output_size", "output_mtime")] == [entry.offset, entry.size1, entry.size2, entry.size3, file_size, file_mtime]
+
+def patch_rows(archive: BigArchive, directory_path: str, known_files: dict[str, list[int]], fingerprints: dict[str, dict[str, Any]]) -> tuple[list[tuple[ET.Element, ET.Element]], dict[str, list[int]]]: # row and segment for every new or changed file, as they are in entries.xml, and the size and mtime of every file
+	records: list[tuple[ET.Element, ET.Element]] = list()
+	file_state: dict[str, list[int]] = dict()
+
+	for file_name in entry_file_names(directory_path): # reads ONLY hash-named files
+		file_stat = os.stat(directory_path + file_name) # taken before the file is read, a later change is found by the next patch
+		file_size: int = file_stat.st_size
+		file_state[file_name] = [file_size, file_stat.st_mtime_ns]
+
+		entry = archive.findEntry(int(file_name, 16))
+		if entry is not None and file_unchanged(entry, file_name, file_size, file_stat.st_mtime_ns, known_files, fingerprints):
+			continue
+		if entry is not None and entry_matches(archive, entry, directory_path + file_name): # unchanged, the entry stays where it is
+			continue
+		row = ET.Element("row", attrib={"hash": file_name})
+		segment = ET.Element("segment", attrib={"case": "2", "u0": "0"})
+
+		if entry is None: # new entries are always compressed
+			ET.SubElement(row, "decompressed_block1_size").text = str(file_size)
+			ET.SubElement(row, "decompressed_block2_size").text = "0"
+		else:
+			ET.SubElement(row, "decompressed_block1_size").text = str(entry.size1)
+			ET.SubElement(row, "decompressed_block2_size").text = str(entry.size2)
+			if archive.isSegment(entry.offset):
+				if archive.readSegment(entry.offset).u0 != 0: # multi_segment_handler would fail after the first appended entries
+					raise Exception(f"{file_name}: objects not supported for now")
 			else:
-				local_decompressed_data = file_to_read.read(2**17)
-				decompressed_data_size = len(local_decompressed_data) 
-				decompressed_main_block_size += decompressed_data_size 
+				segment.set("case", "1")
 
-				local_compressed_data, compressed_data_size = pack_with_deflate(local_decompressed_data) if deflate_available else pack_with_zlib(local_decompressed_data)
-				chunk_data, zero_count = data_to_chunk_pattern(local_compressed_data)
-				data_to_write += chunk_data
-				compressed_data_size += zero_count 
-				compressed_data_size, size_coefficient = get_buffer_rounds(compressed_data_size)
+		records.append((row, segment))
 
-				parameters_dict = {
-					"size": compressed_data_size,
-					"flags": flag_value,
-					"size_coeff": size_coefficient
-				}
+	return records, file_state
 
-				segment_info_list.append(parameters_dict)
+def patch_archive(archive_path: str, directory_path: str, jobs: int = 1, codec_name: str = DEFAULT_CODEC, cache_path: str | None = None, cache_size: int = 0) -> bool: # appends changed entries and a new table, the old table stays as dead space
+	global ENDIANNESS
+	global DIRECTORY
 
-			num_chunks += 1
+	ENDIANNESS = getEndianness(archive_path) #type: ignore
+	if ENDIANNESS is None:
+		return False
 
-			if (not (file_to_read.tell() - decompressed_file_size)):
-				break
-				#remaining_part = file_to_read.read()
+	if not directory_path.endswith(os.sep):
+		directory_path += os.sep
 
-		segment_header = struct.pack(ENDIANNESS + "4sHHI", magic_value.encode(), segment_type, num_chunks, object_count)
+	DIRECTORY = directory_path #type: ignore
 
-		counter = 0
-		for segment_data in segment_info_list:
-			compressed_data_size, flag_value, size_coefficient = segment_data.values()
-			segment_header += struct.pack(ENDIANNESS + "H2B", compressed_data_size, flag_value, size_coefficient)
-			counter += 1
+	with open(archive_path, "r+b") as file:
+		archive = BigArchive(file, ENDIANNESS, os.path.basename(archive_path)) #type: ignore
+		if not archive.entries: # case 0, the segments are not in the file table, a new table would hide them
+			print(f"{archive_path} has no file table, not patched")
+			archive.close()
+			return False
+		# files with the size and mtime of the last patch or of an incremental unpack are not compared with the archive
+		records, file_state = patch_rows(archive, directory_path, load_patch_state(archive_path, directory_path), load_fingerprints(directory_path)) # reads the archive, everything after only appends to it
+		if not records:
+			archive.close()
+			save_patch_state(archive_path, directory_path, file_state)
+			print(f"No new or changed entries for {archive_path}")
+			return True
+		start_compression(jobs, codec_name, cache_path, cache_size)
+
+		table_rows: list[dict[str, int]] = [entry_table_row(entry, entry.offset) for entry in archive.entries]
+		row_indices: dict[int, int] = {table_row["hash"]: row_index for row_index, table_row in enumerate(table_rows)}
+		sorted_table: bool = all(table_rows[row_index]["hash"] < table_rows[row_index + 1]["hash"] for row_index in range(len(table_rows) - 1))
+
+		original_size: int = file.seek(0, os.SEEK_END)
+		try:
+			file.write(b"\x00" * (-file.tell() % 0x10)) # offsets are stored in 16 byte units
+
+			for row, segment in records:
+				if segment.get("case") == "1":
+					table_row = single_segment_handler(row, segment, file) #type: ignore
+				else:
+					table_row = multi_segment_handler(row, segment, file) #type: ignore
+
+				if table_row["hash"] in row_indices:
+					table_rows[row_indices[table_row["hash"]]] = table_row
+				else:
+					row_indices[table_row["hash"]] = len(table_rows)
+					table_rows.append(table_row)
+
+			if sorted_table: # keeps the table sorted by hash, as it is in the original archives
+				table_rows.sort(key=lambda table_row: table_row["hash"])
+
+			write_table(file, table_rows) #type: ignore
+		except BaseException:
+			file.truncate(original_size) # the old table is at the end of the archive again
+			raise
+		finally:
+			archive.close()
+			stop_compression()
+
+	save_patch_state(archive_path, directory_path, file_state) # every file of the folder matches the archive now
+	print(f"Patched {len(records)} new or changed entries in {archive_path}")
+	return True
 
-		segment_header, padding_val = data_to_chunk_pattern(segment_header)
-		data_to_write = segment_header + data_to_write
+def stored_size(archive: BigArchive, entry: BigArchive.Entry) -> int: # size of the entry in the archive, including the padding
+	if not archive.isSegment(entry.offset):
+		return (archive.singleSize(entry) + 0xF) & ~0xF
 
-		current_offset_position = file_to_write.tell()
-		file_to_write.write(data_to_write)
-		
-		table_row_dict = {
-			"hash": int(row.get("hash"), 16),
-			"offset": current_offset_position >> 4,
-			"block1_size": block1_size if block1_size else decompressed_main_block_size, # block1 is static
-			"block2_size": decompressed_main_block_size if block1_size else 0,
-			"compressed_size": len(data_to_write)
-		}
+	return (archive.segmentEnd(archive.readSegment(entry.offset)) - entry.offset + 0xF) & ~0xF
 
-	return table_row_dict
+def compact_archive(archive_path: str, output_path: str | None = None) -> bool: # rewrites the archive without dead space left by patches
+	endianness = getEndianness(archive_path)
+	if endianness is None:
+		return False
+
+	output_path = output_path or archive_path
+	temporary_path: str = output_path + ".tmp"
+
+	with open(archive_path, "rb") as file:
+		archive = BigArchive(file, endianness, os.path.basename(archive_path), use_mmap=True)
+		if not archive.entries: # case 0, only an empty table would be written
+			print(f"{archive_path} has no file table, not compacted")
+			archive.close()
+			return False
+		new_offsets: dict[int, int] = dict() # entries can share the data
+
+		with open(temporary_path, "wb") as file_to_write:
+			for entry in sorted(archive.entries, key=lambda entry: entry.offset):
+				if entry.offset in new_offsets:
+					continue
+				new_offsets[entry.offset] = file_to_write.tell()
+				file_to_write.write(archive.readAt(entry.offset, stored_size(archive, entry)))
+
+			write_table(file_to_write, [entry_table_row(entry, new_offsets[entry.offset]) for entry in archive.entries]) #type: ignore
+			reclaimed_size: int = archive.file_size - file_to_write.tell()
+
+		archive.close()
+
+	os.replace(temporary_path, output_path)
+	print(f"Reclaimed {reclaimed_size} bytes in {output_path}")
+	return True
 
-def big_packer(directory_path: str):
+# VERIFY
+
+VERIFY_ARCHIVE: BigArchive | None = None # opened once in every verify process
+
+def open_verify_archive(archive_path: str, endianness: str) -> None:
+	global VERIFY_ARCHIVE
+	VERIFY_ARCHIVE = BigArchive(open(archive_path, "rb"), endianness, os.path.basename(archive_path), use_mmap=True)
+	if multiprocessing.parent_process() is not None: # pool workers do not run atexit, Finalize runs when the worker exits
+		multiprocessing.util.Finalize(None, close_verify_archive, exitpriority=10)
+
+def close_verify_archive() -> None:
+	global VERIFY_ARCHIVE
+	if VERIFY_ARCHIVE is not None:
+		VERIFY_ARCHIVE.close()
+		VERIFY_ARCHIVE.file.close()
+		VERIFY_ARCHIVE = None
+
+def verify_entry(entry_hash: int, directory_path: str) -> tuple[int, str | None, int]: # hash, mismatch or None, decompressed size
+	entry: BigArchive.Entry = VERIFY_ARCHIVE.findEntry(entry_hash) #type: ignore
+	file_path: str = f"{directory_path}0x{entry_hash:08x}"
+	if not os.path.isfile(file_path):
+		return entry_hash, "no file in the directory", 0
+
+	# both sides are hashed one chunk at a time, so only a chunk of every entry is in memory
+	source_size: int = os.path.getsize(file_path)
+	data_size: int = 0
+	digest = hashlib.blake2b()
+	source_digest = hashlib.blake2b()
+	with open(file_path, "rb") as file_to_read:
+		try:
+			for local_decompressed_data in entry_parts(VERIFY_ARCHIVE, entry): #type: ignore
+				compared_data = local_decompressed_data[:max(source_size - data_size, 0)] # single entries are padded to 16 bytes
+				digest.update(compared_data)
+				source_digest.update(file_to_read.read(len(compared_data)))
+				data_size += len(local_decompressed_data)
+		except zlib.error as error:
+			return entry_hash, f"broken chunk ({error})", 0
+
+	padding_size: int = data_size - source_size
+	if padding_size < 0 or padding_size >= 0x10 or padding_size and VERIFY_ARCHIVE.isSegment(entry.offset): #type: ignore
+		return entry_hash, f"size {data_size} instead of {source_size}", data_size
+	if digest.digest() != source_digest.digest():
+		return entry_hash, "digest mismatch", data_size
+	return entry_hash, None, data_size
+
+def verify_archive(archive_path: str, directory_path: str, jobs: int = 1) -> bool: # decompresses every entry and compares it with the hash-named file of the directory
+	endianness = getEndianness(archive_path)
+	if endianness is None:
+		return False
+
+	if not directory_path.endswith(os.sep):
+		directory_path += os.sep
+
+	open_verify_archive(archive_path, endianness)
+	entry_hashes: list[int] = list(dict.fromkeys(entry.hash for entry in VERIFY_ARCHIVE.entries)) #type: ignore
+	extra_file_names: list[str] = [file_name for file_name in entry_file_names(directory_path) if VERIFY_ARCHIVE.findEntry(int(file_name, 16)) is None] #type: ignore
+
+	start_time: float = time.perf_counter()
+	if jobs > 1: # every process opens the archive itself
+		with ProcessPoolExecutor(jobs, initializer=open_verify_archive, initargs=(archive_path, endianness)) as executor:
+			results = list(executor.map(verify_entry, entry_hashes, [directory_path] * len(entry_hashes), chunksize=16))
+	else:
+		results = [verify_entry(entry_hash, directory_path) for entry_hash in entry_hashes]
+	elapsed_time: float = time.perf_counter() - start_time
+	close_verify_archive()
+
+	mismatch_count: int = 0
+	for entry_hash, mismatch, _data_size in results:
+		if mismatch is not None:
+			print(f"0x{entry_hash:08x}: {mismatch}")
+			mismatch_count += 1
+	for file_name in extra_file_names: # f.e. an entry dropped by the packer
+		print(f"{file_name}: no entry in the archive")
+		mismatch_count += 1
+
+	total_size: int = sum(data_size for _entry_hash, _mismatch, data_size in results)
+	print(f"Verified {len(results)} entries, {mismatch_count} mismatches, {total_size} bytes in {elapsed_time:.2f} s ({total_size / max(elapsed_time, 1e-9) / 2**20:.1f} MB/s)")
+	return mismatch_count == 0
+
+def big_packer(directory_path: str, manifest_format: str | None = None, jobs: int = 1, reference_path: str | None = None, codec_name: str = DEFAULT_CODEC, cache_path: str | None = None, cache_size: int = 0):
 	global ENDIANNESS
 	global DIRECTORY
+	global REFERENCE
 	table_rows: list[dict[str, int]] = []
 
-	if not directory_path.endswith("\\"):
-		directory_path += "\\"
+	if not directory_path.endswith(os.sep):
+		directory_path += os.sep
 
 	DIRECTORY = directory_path #type: ignore
 
-	root = get_tree_root(directory_path)
-	ENDIANNESS = root.get("endianness") #type: ignore
-	file_name: str = root.get("file_name") or ""
+	header, records = get_manifest(directory_path, manifest_format)
+	ENDIANNESS = header["endianness"]
+	file_name: str = header["file_name"]
 
-	row_table = get_tree_table(root)
-	segment_table = get_tree_segments(root)
+	start_compression(jobs, codec_name, cache_path, cache_size)
 
-	check_archive_type(row_table, segment_table)
+	reference_file: io.BufferedReader | None = None
+	reused_count: int = 0
+	if reference_path is not None:
+		reference_file = open(reference_path, "rb")
+		REFERENCE = BigArchive(reference_file, ENDIANNESS, os.path.basename(reference_path), use_mmap=True)
 
 	with open(directory_path + file_name, "wb") as file:
-		rows = row_table.findall("row")
-		segments = segment_table.findall("segment")
-
-		for row, segment in zip(rows, segments):
+		for row, segment in records:
 			case_num = segment.get("case")
 
 			if (case_num == "1"):
 				table_rows.append(single_segment_handler(row, segment, file))
 			elif (case_num == "2"):
-				table_rows.append(multi_segment_handler(row, segment, file))
+				reference_row = reference_segment_handler(row, segment, file) if REFERENCE is not None else None
+				if reference_row is not None:
+					reused_count += 1
+					table_rows.append(reference_row)
+				else:
+					table_rows.append(multi_segment_handler(row, segment, file))
 			else:
 				raise Exception("Unknown case")
 			
-		table_data: bytes = b""
-		entries_count: int = 0
-
-		for entries_data in table_rows:
-			hash_value, offset_value, block1_size, block2_size, compressed_size = entries_data.values()
-			table_data += struct.pack(ENDIANNESS + "5I", hash_value, offset_value, block1_size, block2_size, compressed_size)
-			entries_count += 1
-
-		table_data = struct.pack("<2I", 3, entries_count) + table_data # memory full? Endianness static?
-		
-		table_start_position = file.tell()
-		file.write(table_data)
-
-		table_offset = file.tell() + 4 - table_start_position # integer for offset
-		file.write(struct.pack("<I", table_offset)) # write offset to the end
+		write_table(file, table_rows)
+
+	stop_compression()
+	if REFERENCE is not None:
+		print(f"Reused {reused_count} segments from {reference_path}")
+		REFERENCE.close()
+		REFERENCE = None
+		reference_file.close() #type: ignore
 	return True
 
 # START
-folder_path: str = sys.argv[1:][0]
-
-if not os.path.exists(folder_path):
-	folder_path = input("Path to folder: ")
-
-if not os.path.exists(folder_path):
-	raise Exception("Path does not exist")
-
-if (big_packer(f"{folder_path}")):
-	print("Ready!")
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Pack an unpacked directory into .big archive.")
+	subparsers = parser.add_subparsers(dest="command")
+
+	pack_parser = subparsers.add_parser("pack", help="Pack the whole directory into a new archive (default).")
+	pack_parser.add_argument("folder", nargs="?", help="Path to folder with entries.xml or entries.jsonl.")
+	pack_parser.add_argument("--jobs", type=int, default=1, help="Number of threads used to compress chunks (1 = serial).")
+	pack_parser.add_argument("--reference", default=None, help="Original .big archive, unchanged entries are copied from it without recompression.")
+	pack_parser.add_argument("--manifest", choices=("xml", "jsonl"), default=None, help="Manifest to read (default: the newer of entries.jsonl and entries.xml).")
+	pack_parser.add_argument("--codec", choices=CODECS.keys(), default=DEFAULT_CODEC, help="Chunk compressor, see the benchmark command.")
+	pack_parser.add_argument("--cache", default=None, help="SQLite file with compressed chunks of the previous builds, unchanged chunks are not compressed again.")
+	pack_parser.add_argument("--cache-size", type=int, default=1024, help="Size limit of the chunk cache in MiB, least recently used chunks are removed.")
+
+	patch_parser = subparsers.add_parser("patch", help="Append new or changed entries to an existing archive.")
+	patch_parser.add_argument("archive", help="Path to .big file, it is modified in place.")
+	patch_parser.add_argument("folder", help="Path to folder with hash-named files (f.e. 0x5669ff3c), files that match the archive are skipped.")
+	patch_parser.add_argument("--jobs", type=int, default=1, help="Number of threads used to compress chunks (1 = serial).")
+	patch_parser.add_argument("--codec", choices=CODECS.keys(), default=DEFAULT_CODEC, help="Chunk compressor, see the benchmark command.")
+	patch_parser.add_argument("--cache", default=None, help="SQLite file with compressed chunks of the previous builds, unchanged chunks are not compressed again.")
+	patch_parser.add_argument("--cache-size", type=int, default=1024, help="Size limit of the chunk cache in MiB, least recently used chunks are removed.")
+
+	compact_parser = subparsers.add_parser("compact", help="Rewrite an archive without the space left by patches.")
+	compact_parser.add_argument("archive", help="Path to .big file.")
+	compact_parser.add_argument("--output", default=None, help="Path to the compacted archive (default: replaces the archive).")
+
+	verify_parser = subparsers.add_parser("verify", help="Decompress every entry of an archive and compare it with the files of the directory.")
+	verify_parser.add_argument("archive", help="Path to .big file.")
+	verify_parser.add_argument("folder", help="Path to folder with hash-named files (f.e. the packed directory).")
+	verify_parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Number of processes used to decompress entries (default: all cores).")
+
+	benchmark_parser = subparsers.add_parser("benchmark", help="Compare output size and speed of the chunk compressors.")
+	benchmark_parser.add_argument("folder", help="Path to folder with hash-named files (f.e. an unpacked archive).")
+	benchmark_parser.add_argument("--codec", action="append", choices=CODECS.keys(), default=[], help="Codec to measure, can be repeated (default: all installed).")
+	benchmark_parser.add_argument("--sample-size", type=int, default=64, help="Size limit of the sample in MiB, the files are read in order until it is reached.")
+
+	argv: list[str] = sys.argv[1:]
+	if not argv or argv[0] not in subparsers.choices and argv[0] not in ("-h", "--help"):
+		argv.insert(0, "pack") # "bigpc3_pack.py folder" is still supported
+	args = parser.parse_args(argv)
+
+	if args.command == "patch":
+		if (patch_archive(args.archive, args.folder, args.jobs, args.codec, args.cache, args.cache_size << 20)):
+			print("Ready!")
+			sys.exit()
+		sys.exit(1)
+	if args.command == "verify":
+		sys.exit(0 if verify_archive(args.archive, args.folder, args.jobs) else 1)
+	if args.command == "benchmark":
+		benchmark_codecs(args.folder, args.codec, args.sample_size << 20)
+		sys.exit()
+	if args.command == "compact":
+		if (compact_archive(args.archive, args.output)):
+			print("Ready!")
+			sys.exit()
+		sys.exit(1)
+
+	folder_path: str = args.folder or ""
+
+	if not os.path.exists(folder_path):
+		folder_path = input("Path to folder: ")
+
+	if not os.path.exists(folder_path):
+		raise Exception("Path does not exist")
+
+	if (big_packer(f"{folder_path}", args.manifest, args.jobs, args.reference, args.codec, args.cache, args.cache_size << 20)):
+		print("Ready!")
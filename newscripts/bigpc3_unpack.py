@@ -1,13 +1,24 @@
-from io import BufferedReader
+from io import BufferedReader, BufferedWriter, TextIOWrapper
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from fnmatch import fnmatchcase
 import sys, os, errno
-from struct import calcsize, unpack, unpack_from
+import argparse
+import hashlib
+import heapq
+import json
+import mmap
+import time
+from struct import calcsize, iter_unpack, pack, unpack, unpack_from
+from typing import Any, Iterable
 import zlib
-import xml.etree.ElementTree as ET
+from xml.sax.saxutils import XMLGenerator
 
-entry_xml_root: ET.Element
-entry_xml_segments: ET.Element
+CHUNK_SIZE: int = 0x20000 # decompressed size of a full chunk
 
-entries_dir: str
+INDEX_MAGIC: bytes = b'BIDX'
+INDEX_VERSION: int = 2
 
 def align(x: int, a: int) -> int:
 	return (x + (a - 1)) & ~(a - 1)
@@ -19,6 +30,94 @@ def mkdirSafe(dirs: str) -> None:
 		if e.errno != errno.EEXIST:
 			raise
 
+class ManifestWriter:
+	# writes entries.xml while the archive is processed, so no element is kept in memory
+	out_file: BufferedWriter
+	generator: XMLGenerator
+
+	def __init__(self, path: str, endianness: str, file_name: str) -> None:
+		self.out_file = open(path, 'wb')
+		self.generator = XMLGenerator(self.out_file, 'utf-8', short_empty_elements=True)
+		self.generator.startDocument()
+		self.generator.startElement('root', {'endianness': endianness, 'file_name': file_name})
+
+	def textElement(self, name: str, text: str, attrib: dict[str, str] = {}) -> None:
+		self.generator.startElement(name, attrib)
+		self.generator.characters(text)
+		self.generator.endElement(name)
+
+	def writeTable(self, archive_type: int, entries: list['BigArchive.Entry']) -> None:
+		self.generator.startElement('table', {'archive_type': f'{archive_type}', 'num_entries': f'{len(entries)}'}) # num_entries is necessary, since their number can be 0
+		for entry in entries:
+			self.generator.ignorableWhitespace('\n')
+			self.generator.startElement('row', {'hash': f'0x{entry.hash:08x}', 'offset': f'0x{entry.offset:08x}'})
+			self.textElement('decompressed_block1_size', f'{entry.size1}')
+			self.textElement('decompressed_block2_size', f'{entry.size2}')
+			self.textElement('compressed_size', f'{entry.size3}')
+			self.generator.endElement('row')
+		self.generator.endElement('table')
+		self.generator.startElement('segments', {})
+
+	def writeSegment(self, case: int, entry: 'BigArchive.Entry | None', segment: 'BigArchive.Segment | None') -> None:
+		# 0 case indicates that the segment is proceed without a entries table. Without hash
+		# 1 case indicates that the segment is proceed with 1 chunk (without multithreading?)
+		# 2 case indicates that the segment is proceed with many chunks (with multithreading?)
+		attrib: dict[str, str] = {'case': f'{case}'}
+		if entry is not None:
+			attrib['hash'] = f'0x{entry.hash:08x}'
+		if segment is not None:
+			attrib.update({'type': f'{segment.type}', 'u0': f'{segment.u0}', 'u1': f'{segment.u1}', 'u2': f'{segment.u2}', 'u3': f'{segment.u3}'})
+
+		self.generator.ignorableWhitespace('\n')
+		self.generator.startElement('segment', attrib)
+		if segment is not None:
+			for uobj in segment.objects:
+				self.textElement('object', str(uobj))
+			for chunk in segment.chunks:
+				# size & offset probably useless
+				self.generator.startElement('chunk', {'flags': f'0x{chunk.flags:02x}', 'size_coefficient': f'{chunk.size_coeff}', 'size': f'{chunk.size}', 'offset': f'{chunk.offset}'})
+				self.generator.endElement('chunk')
+		self.generator.endElement('segment')
+
+	def close(self) -> None:
+		self.generator.endElement('segments')
+		self.generator.endElement('root')
+		self.generator.endDocument()
+		self.out_file.close()
+
+class JsonLinesManifestWriter:
+	# writes entries.jsonl: a header line, then one line per segment with the table row of its entry
+	out_file: TextIOWrapper
+	header: dict[str, str | int]
+
+	def __init__(self, path: str, endianness: str, file_name: str) -> None:
+		self.out_file = open(path, 'w')
+		self.header = {'endianness': endianness, 'file_name': file_name}
+
+	def writeLine(self, record: dict[str, Any]) -> None:
+		self.out_file.write(json.dumps(record, separators=(',', ':')))
+		self.out_file.write('\n')
+
+	def writeTable(self, archive_type: int, entries: list['BigArchive.Entry']) -> None:
+		self.writeLine({**self.header, 'archive_type': archive_type, 'num_entries': len(entries)})
+
+	def writeSegment(self, case: int, entry: 'BigArchive.Entry | None', segment: 'BigArchive.Segment | None') -> None:
+		record: dict[str, Any] = {'case': case}
+		if entry is not None:
+			record.update({'hash': f'0x{entry.hash:08x}', 'offset': f'0x{entry.offset:08x}', 'decompressed_block1_size': entry.size1, 'decompressed_block2_size': entry.size2, 'compressed_size': entry.size3})
+		if segment is not None:
+			record.update({'type': segment.type, 'u0': segment.u0, 'u1': segment.u1, 'u2': segment.u2, 'u3': segment.u3, 'objects': segment.objects})
+			record['chunks'] = [{'flags': f'0x{chunk.flags:02x}', 'size_coefficient': chunk.size_coeff, 'size': chunk.size, 'offset': chunk.offset} for chunk in segment.chunks]
+		self.writeLine(record)
+
+	def close(self) -> None:
+		self.out_file.close()
+
+MANIFEST_WRITERS: dict[str, tuple[str, type[ManifestWriter] | type[JsonLinesManifestWriter]]] = {
+	'xml': ('entries.xml', ManifestWriter),
+	'jsonl': ('entries.jsonl', JsonLinesManifestWriter),
+}
+
 class BigArchive:
 	class Entry:
 		hash: int
@@ -39,108 +138,579 @@ class BigArchive:
 		def __init__(self) -> None:
 			pass
 
+	class Segment:
+		offset: int
+		type: int
+		u0: int
+		u1: int
+		u2: int
+		u3: int
+		objects: list[int]
+		chunks: list['BigArchive.Chunk']
+		table_end: int # end of the chunk table (before the alignment of the data)
+
+		def __init__(self) -> None:
+			pass
+
+	class EntryWriter:
+		# receives the inflated chunks of one entry in order, either into a preallocated buffer or straight into the output file
+		path: str
+		size: int
+		data: bytearray | None
+		data_size: int
+		out_file: BufferedWriter | None
+
+		def __init__(self, path: str, size: int, stream: bool) -> None:
+			self.path = path
+			self.size = size
+			self.data_size = 0
+			if stream:
+				self.data = None
+				self.out_file = open(path, 'wb')
+			else:
+				self.data = bytearray(size)
+				self.out_file = None
+
+		def write(self, part: bytes | memoryview) -> None:
+			if self.out_file:
+				self.out_file.write(part)
+			else:
+				self.data[self.data_size:self.data_size + len(part)] = part #type: ignore
+			self.data_size += len(part)
+
+		def close(self) -> None:
+			if self.out_file:
+				self.out_file.close()
+				return
+			del self.data[self.data_size:] #type: ignore
+			with open(self.path, 'wb') as out_file:
+				out_file.write(self.data) #type: ignore
+			self.data = None
+
 	endianness: str
 	file: BufferedReader
 	file_size: int
 	file_name: str
 
+	mapping: mmap.mmap | None
+	view: memoryview | None
+
 	file_table_offset: int
+	archive_type: int
 	entries: list[Entry]
+	entries_by_hash: dict[int, Entry]
+
+	segments: dict[int, Segment] # parsed segs headers by offset
+	single_offsets: set[int] # offsets of entries known to be stored without segs header
+	scanned_segments: list[Segment] | None # case 0, segments found without the file table
+
+	hash_filter: set[int] | None # only these entries are unpacked
+	magic_filter: list[bytes] | None # only entries starting with one of these are unpacked
 
-	def __init__(self, file: BufferedReader, endianness: str, file_name: str):
+	jobs: int
+	pool: ThreadPoolExecutor | None
+	pending: deque[tuple[EntryWriter, Future[bytes] | None]] # None closes the writer
+	pending_bytes: int
+
+	stream: bool
+	memory_limit: int
+
+	manifest_format: str
+	manifest: ManifestWriter | JsonLinesManifestWriter | None
+
+	incremental: bool
+	fingerprints: dict[str, dict[str, int | str]] # by 0x-hash, stored in fingerprints.json
+
+	def __init__(self, file: BufferedReader, endianness: str, file_name: str, *, jobs: int = 1, use_mmap: bool = False, use_index: bool = False, stream: bool = False, memory_limit: int = 0, incremental: bool = False, manifest_format: str = 'xml', hash_filter: set[int] | None = None, magic_filter: list[bytes] | None = None):
 		self.endianness = endianness
 		self.file = file
 		self.file_name = file_name
+		self.jobs = jobs
+		self.pool = None
+		self.pending = deque()
+		self.pending_bytes = 0
+		self.stream = stream
+		self.memory_limit = memory_limit
+		self.incremental = incremental
+		self.fingerprints = {}
+		self.manifest_format = manifest_format
+		self.manifest = None
+		self.entries_by_hash = {}
+		self.segments = {}
+		self.single_offsets = set()
+		self.scanned_segments = None
+		self.hash_filter = hash_filter
+		self.magic_filter = magic_filter
 
-		current_pos: int = self.file.tell()
-		self.file.seek(0, os.SEEK_END)
-		self.file_size = self.file.tell()
-		self.file.seek(current_pos)
-		self.file.seek(self.file_size - calcsize('<I'))
-
-		self.file_table_offset = self.file_size - unpack('<I', self.file.read(calcsize('<I')))[0]
-		self.file.seek(self.file_table_offset)
+		self.mapping = None
+		self.view = None
+		if use_mmap:
+			# every read becomes a slice of the mapping, headers are parsed in place and payloads are passed to zlib without copying
+			self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+			self.view = memoryview(self.mapping)
+			self.file_size = len(self.mapping)
+		else:
+			current_pos: int = self.file.tell()
+			self.file.seek(0, os.SEEK_END)
+			self.file_size = self.file.tell()
+			self.file.seek(current_pos)
 
-		(archive_type, num_entries) = unpack('<2I', self.file.read(calcsize('<2I')))
-		if archive_type != 3:
-			print(f'Unsupported archive type {archive_type}')
+		if use_index and self.loadIndex():
 			return
 
-		entry_xml_table = ET.SubElement(entry_xml_root, 'table', attrib={'archive_type': f'{archive_type}', 'num_entries': f'{num_entries}'}) # num_entries is necessary, since their number can be 0
+		self.file_table_offset = self.file_size - self.unpackAt('<I', self.file_size - calcsize('<I'))[0]
+
+		(self.archive_type, num_entries) = self.unpackAt('<2I', self.file_table_offset)
+		if self.archive_type != 3:
+			print(f'Unsupported archive type {self.archive_type}')
+			return
 
 		self.entries = []
-		for _ in range(num_entries):
+		table_data = self.readAt(self.file_table_offset + calcsize('<2I'), num_entries * calcsize(self.endianness + '5I'))
+		for (entry_hash, entry_offset, size1, size2, size3) in iter_unpack(self.endianness + '5I', table_data):
 			entry: BigArchive.Entry = self.Entry()
 
-			(entry.hash, entry_offset, entry.size1, entry.size2, entry.size3) = unpack(self.endianness + '5I', self.file.read(calcsize(self.endianness + '5I')))
+			(entry.hash, entry.size1, entry.size2, entry.size3) = (entry_hash, size1, size2, size3)
 			entry_offset_lo: int = entry_offset << 4
 			_entry_offset_hi: int = entry_offset >> 28
 			entry.offset = entry_offset_lo
 			# size3 for compressed segs
 
-			entry_xml_table_row = ET.SubElement(entry_xml_table, 'row', attrib={'hash': f'0x{entry.hash:08x}', 'offset': f'0x{entry.offset:08x}'})
-			ET.SubElement(entry_xml_table_row, 'decompressed_block1_size').text = f'{entry.size1}'
-			ET.SubElement(entry_xml_table_row, 'decompressed_block2_size').text = f'{entry.size2}'
-			ET.SubElement(entry_xml_table_row, 'compressed_size').text = f'{entry.size3}'
+			self.entries.append(entry)
+		del table_data
+
+		if use_index:
+			self.buildIndex()
+
+	def indexPath(self) -> str:
+		return f'{self.file.name}.idx'
 
+	def loadIndex(self) -> bool:
+		# the sidecar index is only trusted if it was built from an archive of the same size and mtime
+		try:
+			with open(self.indexPath(), 'rb') as index_file:
+				index_data: bytes = index_file.read()
+		except OSError:
+			return False
+
+		stat = os.fstat(self.file.fileno())
+		header_format: str = '<4sIQQIQI'
+		if len(index_data) < calcsize(header_format):
+			return False
+		(magic, version, archive_size, archive_mtime, archive_type, file_table_offset, num_entries) = unpack_from(header_format, index_data)
+		if magic != INDEX_MAGIC or version != INDEX_VERSION or archive_size != stat.st_size or archive_mtime != stat.st_mtime_ns:
+			return False
+
+		self.archive_type = archive_type
+		self.file_table_offset = file_table_offset
+		self.entries = []
+		offset: int = calcsize(header_format)
+		for _ in range(num_entries):
+			entry: BigArchive.Entry = self.Entry()
+			(entry.hash, entry.offset, entry.size1, entry.size2, entry.size3, is_segment) = unpack_from('<IQ3IB', index_data, offset)
+			offset += calcsize('<IQ3IB')
 			self.entries.append(entry)
 
-	def dumpEntry(self, entry: Entry, data: bytes) -> None:
-		entry_dir: str = f'entries/{self.file_name}'
-		mkdirSafe(entry_dir)
-		with open(f'{entry_dir}/0x{entry.hash:08x}', 'wb') as out_file:
-			out_file.write(data)
+			if not is_segment:
+				self.single_offsets.add(entry.offset)
+				continue
 
-	def processSingle(self, entry: Entry) -> None:
-		size: int = entry.size3
-		if size == 0:
-			size = entry.size1 + entry.size2
-		self.file.seek(entry.offset)
-		data: bytes = self.file.read(size)
-		self.dumpEntry(entry, data)
-
-		# 1 case indicates that the segment is proceed with 1 chunk (without multithreading?) 
-		entry_xml_segment: ET.Element = ET.SubElement(entry_xml_segments, 'segment', attrib={'case': '1', 'hash': f'0x{entry.hash:08x}'}) #type: ignore
-
-	def processMulti(self, entry: Entry) -> None:
-		self.file.seek(entry.offset)
-		(_magic, type, num_chunks, u0, u1, u2, u3) = unpack(self.endianness + 'I2H4B', self.file.read(calcsize(self.endianness + 'I2H4B')))
-		print(f'\tType: {type}')
-		print(f'\tNum chunks: {num_chunks}')
-		print(f'\tUnknown: {u0} {u1} {u2} {u3}')
-		data_offset: int = align(self.file.tell() + u0 * calcsize(self.endianness + 'I') + num_chunks * calcsize(self.endianness + '2H'), 16)
-
-		# 2 case indicates that the segment is proceed with many chunks (with multithreading?) 
-		entry_xml_segment = ET.SubElement(entry_xml_segments, 'segment', attrib={'case': '2', 'hash': f'0x{entry.hash:08x}', 'type': f'{type}', 'u0': f'{u0}', 'u1': f'{u1}', 'u2': f'{u2}', 'u3': f'{u3}'})
-
-		uobjs: list[int] = []
-		for _ in range(u0):
-			uobj = unpack(self.endianness + 'I', self.file.read(calcsize(self.endianness + 'I')))[0]
-			uobjs.append(uobj)
-
-		chunks: list[BigArchive.Chunk] = []
-		for _ in range(num_chunks):
+			offset = self.loadSegmentRecord(entry.offset, index_data, offset)
+
+		# case 0 archives keep the offsets of the scanned segments after the entries
+		(num_scanned,) = unpack_from('<I', index_data, offset)
+		offset += calcsize('<I')
+		if not self.entries:
+			self.scanned_segments = []
+		for _ in range(num_scanned):
+			(segment_offset,) = unpack_from('<Q', index_data, offset)
+			offset = self.loadSegmentRecord(segment_offset, index_data, offset + calcsize('<Q'))
+			self.scanned_segments.append(self.segments[segment_offset]) #type: ignore
+		return True
+
+	def loadSegmentRecord(self, segment_offset: int, index_data: bytes, offset: int) -> int:
+		segment: BigArchive.Segment = self.Segment()
+		segment.offset = segment_offset
+		(segment.type, segment.u0, segment.u1, segment.u2, segment.u3, num_chunks, segment.table_end) = unpack_from('<H4BHQ', index_data, offset)
+		offset += calcsize('<H4BHQ')
+		segment.objects = list(unpack_from(f'<{segment.u0}I', index_data, offset))
+		offset += segment.u0 * calcsize('<I')
+
+		segment.chunks = []
+		data_offset: int = align(segment.table_end, 16)
+		for (size, flags, size_coeff) in iter_unpack('<I2B', index_data[offset:offset + num_chunks * calcsize('<I2B')]):
 			chunk = self.Chunk()
+			(chunk.size, chunk.flags, chunk.size_coeff) = (size, flags, size_coeff)
+			chunk.offset = data_offset
+			data_offset += chunk.size
+			segment.chunks.append(chunk)
+		offset += num_chunks * calcsize('<I2B')
+
+		self.segments[segment.offset] = segment
+		return offset
+
+	@staticmethod
+	def segmentRecord(segment: Segment) -> bytes:
+		record = bytearray(pack('<H4BHQ', segment.type, segment.u0, segment.u1, segment.u2, segment.u3, len(segment.chunks), segment.table_end))
+		record += pack(f'<{segment.u0}I', *segment.objects)
+		for chunk in segment.chunks:
+			record += pack('<I2B', chunk.size, chunk.flags, chunk.size_coeff)
+		return bytes(record)
+
+	def buildIndex(self) -> None:
+		stat = os.fstat(self.file.fileno())
+		index_data = bytearray(pack('<4sIQQIQI', INDEX_MAGIC, INDEX_VERSION, stat.st_size, stat.st_mtime_ns, self.archive_type, self.file_table_offset, len(self.entries)))
+		for entry in self.entries:
+			is_segment: bool = self.isSegment(entry.offset)
+			index_data += pack('<IQ3IB', entry.hash, entry.offset, entry.size1, entry.size2, entry.size3, is_segment)
+			if not is_segment:
+				self.single_offsets.add(entry.offset)
+				continue
+
+			segment: BigArchive.Segment = self.readSegment(entry.offset)
+			self.segments[segment.offset] = segment
+			index_data += self.segmentRecord(segment)
+
+		scanned_segments: list[BigArchive.Segment] = self.scanSegments() if not self.entries else []
+		index_data += pack('<I', len(scanned_segments))
+		for segment in scanned_segments:
+			index_data += pack('<Q', segment.offset) + self.segmentRecord(segment)
+
+		try:
+			with open(self.indexPath(), 'wb') as index_file:
+				index_file.write(index_data)
+		except OSError as e:
+			print(f'Failed to write index {self.indexPath()}: {e}')
+
+	def close(self) -> None:
+		if self.view is not None:
+			self.view.release()
+			self.view = None
+		if self.mapping is not None:
+			self.mapping.close()
+			self.mapping = None
+
+	def readAt(self, offset: int, size: int) -> bytes | memoryview:
+		if self.view is not None:
+			return self.view[offset:offset + size]
+		self.file.seek(offset)
+		return self.file.read(size)
+
+	def unpackAt(self, format: str, offset: int) -> tuple[Any, ...]:
+		if self.view is not None:
+			return unpack_from(format, self.view, offset)
+		return unpack(format, self.readAt(offset, calcsize(format)))
+
+	def isSegment(self, offset: int) -> bool:
+		if offset in self.segments:
+			return True
+		if offset in self.single_offsets:
+			return False
+		return self.unpackAt(self.endianness + 'I', offset)[0] == unpack_from(b'>I', b'segs')[0]
 
-			(chunk.size, chunk.flags, chunk.size_coeff) = unpack(self.endianness + 'H2B', self.file.read(calcsize(self.endianness + 'H2B')))
+	def segmentEnd(self, segment: Segment) -> int:
+		return segment.chunks[-1].offset + segment.chunks[-1].size if segment.chunks else segment.table_end
+
+	def scanSegments(self) -> list[Segment]:
+		# case 0: there is no file table, segments are found by their magic ('sges' on PC), padding between them is skipped by find()
+		if self.scanned_segments is not None:
+			return self.scanned_segments
+
+		mapping: mmap.mmap = self.mapping if self.mapping is not None else mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		magic: bytes = pack(self.endianness + 'I', unpack_from(b'>I', b'segs')[0])
+		self.scanned_segments = []
+		try:
+			offset: int = 0
+			while (offset := mapping.find(magic, offset, self.file_table_offset)) != -1:
+				if offset % 16: # segments are aligned to 16 bytes
+					offset += 1
+					continue
+				segment: BigArchive.Segment = self.readSegment(offset)
+				self.segments[offset] = segment
+				self.scanned_segments.append(segment)
+				offset = self.segmentEnd(segment)
+		finally:
+			if mapping is not self.mapping:
+				mapping.close()
+		return self.scanned_segments
+
+	def readSegment(self, offset: int) -> Segment:
+		if offset in self.segments:
+			return self.segments[offset]
+
+		segment: BigArchive.Segment = self.Segment()
+		segment.offset = offset
+
+		(_magic, segment.type, num_chunks, segment.u0, segment.u1, segment.u2, segment.u3) = self.unpackAt(self.endianness + 'I2H4B', offset)
+		offset += calcsize(self.endianness + 'I2H4B')
+		data_offset: int = align(offset + segment.u0 * calcsize(self.endianness + 'I') + num_chunks * calcsize(self.endianness + '2H'), 16)
+
+		segment.objects = list(self.unpackAt(f'{self.endianness}{segment.u0}I', offset))
+		offset += segment.u0 * calcsize(self.endianness + 'I')
+
+		segment.chunks = []
+		for (size, flags, size_coeff) in iter_unpack(self.endianness + 'H2B', self.readAt(offset, num_chunks * calcsize(self.endianness + 'H2B'))):
+			chunk = self.Chunk()
+
+			(chunk.size, chunk.flags, chunk.size_coeff) = (size, flags, size_coeff)
 
 			chunk.offset = data_offset
 			chunk.size += 0x10000 * chunk.size_coeff
 			data_offset += chunk.size
-			chunks.append(chunk)
+			segment.chunks.append(chunk)
+		segment.table_end = offset + num_chunks * calcsize(self.endianness + 'H2B')
+
+		return segment
+
+	def stats(self, top: int = 10) -> dict[str, Any]:
+		# built from the file table and the segs headers only, no chunk is inflated
+		single: dict[str, int] = {'count': 0, 'size': 0, 'stored_size': 0}
+		multi: dict[str, int] = {'count': 0, 'size': 0, 'stored_size': 0, 'chunks': 0, 'stored_chunks': 0, 'objects': 0, 'multiblock': 0}
+		sizes: list[tuple[int, int, int, str]] = []
+
+		for entry in self.entries:
+			size: int = entry.size1 + entry.size2
+			if self.isSegment(entry.offset):
+				segment: BigArchive.Segment = self.readSegment(entry.offset)
+				(group, stored_size, kind) = (multi, entry.size3, 'multi')
+				multi['chunks'] += len(segment.chunks)
+				multi['stored_chunks'] += sum(not chunk.flags & 0x10 for chunk in segment.chunks)
+				multi['objects'] += len(segment.objects)
+				multi['multiblock'] += bool(entry.size2)
+			else:
+				(group, stored_size, kind) = (single, self.singleSize(entry), 'single')
+			group['count'] += 1
+			group['size'] += size
+			group['stored_size'] += stored_size
+			sizes.append((size, stored_size, entry.hash, kind))
+
+		segments: list[BigArchive.Segment] = self.scanSegments() if not self.entries else []
+		return {
+			'file': self.file_name,
+			'archive_size': self.file_size,
+			'archive_type': self.archive_type,
+			'entries': len(self.entries),
+			'size': single['size'] + multi['size'],
+			'stored_size': single['stored_size'] + multi['stored_size'],
+			'single': single,
+			'multi': multi,
+			'case0_segments': len(segments),
+			'case0_stored_size': sum(self.segmentEnd(segment) - segment.offset for segment in segments),
+			'largest': [{'hash': f'0x{entry_hash:08x}', 'type': kind, 'size': size, 'stored_size': stored_size} for (size, stored_size, entry_hash, kind) in heapq.nlargest(top, sizes)],
+		}
+
+	@staticmethod
+	def singleSize(entry: Entry) -> int:
+		size: int = entry.size3
+		if size == 0:
+			size = entry.size1 + entry.size2
+		return size
+
+	def readSingle(self, entry: Entry) -> bytes | memoryview:
+		return self.readAt(entry.offset, self.singleSize(entry))
+
+	def readChunk(self, entry: Entry, chunk: Chunk) -> bytes | memoryview:
+		return self.readAt(chunk.offset, chunk.size if chunk.flags & 0x10 else entry.size1) # chunk.size isnt used, since flag 0x00 assumes that the file smaller in size without compression.
+
+	def findEntry(self, entry_hash: int) -> Entry | None:
+		if not self.entries_by_hash:
+			self.entries_by_hash = {entry.hash: entry for entry in self.entries}
+		return self.entries_by_hash.get(entry_hash)
 
-		data: bytes = b''
+	def readEntry(self, entry: Entry) -> bytes:
+		# only the entry's own segment is read and inflated
+		if not self.isSegment(entry.offset):
+			return bytes(self.readSingle(entry))
+		segment: BigArchive.Segment = self.readSegment(entry.offset)
+		return bytes(self.assembleEntry(entry, (self.inflateChunk(chunk, self.readChunk(entry, chunk)) for chunk in segment.chunks)))
 
-		for i in range(len(uobjs)):
-			uobj: int = uobjs[i]
+	@staticmethod
+	def assembleEntry(entry: Entry, parts: Iterable[bytes | memoryview]) -> bytearray:
+		# the buffer is allocated once from the decompressed size in the table, so each chunk is copied only once
+		data = bytearray(entry.size1 + entry.size2)
+		data_size: int = 0
+		for part in parts:
+			data[data_size:data_size + len(part)] = part
+			data_size += len(part)
+		del data[data_size:]
+		return data
+
+	def entryPath(self, entry: Entry) -> str:
+		entry_dir: str = f'entries/{self.file_name}'
+		mkdirSafe(entry_dir)
+		return f'{entry_dir}/0x{entry.hash:08x}'
+
+	def dumpEntry(self, entry: Entry, data: bytes | memoryview) -> None:
+		with open(self.entryPath(entry), 'wb') as out_file:
+			out_file.write(data)
+
+	def streamEntry(self, size: int) -> bool:
+		# half of the limit is left for the chunks in flight
+		return self.stream or bool(self.memory_limit and size > self.memory_limit // 2)
+
+	def dumpSingle(self, entry: Entry) -> None:
+		size: int = self.singleSize(entry)
+		if not self.streamEntry(size):
+			self.dumpEntry(entry, self.readSingle(entry))
+			return
+		with open(self.entryPath(entry), 'wb') as out_file:
+			for offset in range(0, size, CHUNK_SIZE):
+				out_file.write(self.readAt(entry.offset + offset, min(CHUNK_SIZE, size - offset)))
+
+	def extractEntry(self, entry: Entry) -> None:
+		if not self.isSegment(entry.offset):
+			self.dumpSingle(entry)
+			return
+		writer: BigArchive.EntryWriter = self.openEntry(entry)
+		for chunk in self.readSegment(entry.offset).chunks:
+			writer.write(self.inflateChunk(chunk, self.readChunk(entry, chunk)))
+		self.closeEntry(writer)
+
+	def fingerprint(self, entry: Entry) -> dict[str, int | str]:
+		# the digest covers the whole stored segment (segs header, chunk table and compressed chunks)
+		end: int = entry.offset + self.singleSize(entry)
+		if self.isSegment(entry.offset):
+			end = self.segmentEnd(self.readSegment(entry.offset))
+
+		digest = hashlib.blake2b(digest_size=16)
+		for offset in range(entry.offset, end, CHUNK_SIZE):
+			digest.update(self.readAt(offset, min(CHUNK_SIZE, end - offset)))
+
+		return {'offset': entry.offset, 'size1': entry.size1, 'size2': entry.size2, 'size3': entry.size3, 'digest': digest.hexdigest()}
+
+	def isUnchanged(self, entry: Entry, fingerprint: dict[str, int | str]) -> bool:
+		old_fingerprint = self.fingerprints.get(f'0x{entry.hash:08x}')
+		if not old_fingerprint or any(old_fingerprint.get(key) != value for (key, value) in fingerprint.items()):
+			return False
+		try:
+			stat = os.stat(self.entryPath(entry))
+		except OSError:
+			return False
+		return stat.st_size == old_fingerprint.get('output_size') and stat.st_mtime_ns == old_fingerprint.get('output_mtime')
+
+	def loadFingerprints(self) -> None:
+		try:
+			with open(f'entries/{self.file_name}/fingerprints.json', 'r') as json_file:
+				self.fingerprints = json.load(json_file)
+		except (OSError, ValueError):
+			self.fingerprints = {}
+
+	def saveFingerprints(self, fingerprints: dict[str, dict[str, int | str]]) -> None:
+		for entry in self.entries:
+			if f'0x{entry.hash:08x}' not in fingerprints:
+				# filtered out, the fingerprint of the last unpack is kept
+				if f'0x{entry.hash:08x}' in self.fingerprints:
+					fingerprints[f'0x{entry.hash:08x}'] = self.fingerprints[f'0x{entry.hash:08x}']
+				continue
+			fingerprint = fingerprints[f'0x{entry.hash:08x}']
+			stat = os.stat(self.entryPath(entry))
+			fingerprint['output_size'] = stat.st_size
+			fingerprint['output_mtime'] = stat.st_mtime_ns
+
+		self.fingerprints = fingerprints
+		with open(f'entries/{self.file_name}/fingerprints.json', 'w') as json_file:
+			json.dump(self.fingerprints, json_file)
+
+	def openEntry(self, entry: Entry) -> EntryWriter:
+		return self.openWriter(self.entryPath(entry), entry.size1 + entry.size2)
+
+	def openWriter(self, path: str, size: int) -> EntryWriter:
+		stream: bool = self.streamEntry(size)
+		writer: BigArchive.EntryWriter = self.EntryWriter(path, size, stream)
+		if not stream:
+			# the buffer is held until the last chunk is written
+			if self.pool:
+				self.flushPending(self.jobs * 4, self.memory_limit - size if self.memory_limit else None)
+			self.pending_bytes += size
+		return writer
+
+	def closeEntry(self, writer: EntryWriter) -> None:
+		if writer.data is not None:
+			self.pending_bytes -= writer.size
+		writer.close()
+
+	def processSingle(self, entry: Entry, skip: bool = False) -> None:
+		if not skip:
+			self.dumpSingle(entry)
+
+		self.manifest.writeSegment(1, entry, None) #type: ignore
+
+	def peekEntry(self, entry: Entry, size: int) -> bytes:
+		# the first bytes of the entry, only the beginning of the first chunk is inflated
+		if not self.isSegment(entry.offset):
+			return bytes(self.readAt(entry.offset, min(size, self.singleSize(entry))))
+		segment: BigArchive.Segment = self.readSegment(entry.offset)
+		if not segment.chunks:
+			return b''
+		payload: bytes | memoryview = self.readChunk(entry, segment.chunks[0])
+		if segment.chunks[0].flags & 0x10:
+			return zlib.decompressobj(-15).decompress(payload, size)
+		return bytes(payload[:size])
+
+	def matchesFilter(self, entry: Entry) -> bool:
+		if self.hash_filter is not None and entry.hash not in self.hash_filter:
+			return False
+		if self.magic_filter:
+			return self.peekEntry(entry, max(map(len, self.magic_filter))).startswith(tuple(self.magic_filter))
+		return True
+
+	def queueChunk(self, writer: EntryWriter, chunk: Chunk, payload: bytes | memoryview) -> None:
+		if self.pool:
+			# chunks are inflated by the workers while the next ones are read, written in flushPending
+			self.pending.append((writer, self.pool.submit(self.inflateChunk, chunk, payload)))
+			self.pending_bytes += CHUNK_SIZE
+			self.flushPending(self.jobs * 4, self.memory_limit or None)
+		else:
+			writer.write(self.inflateChunk(chunk, payload))
+
+	def finishWriter(self, writer: EntryWriter) -> None:
+		if self.pool:
+			self.pending.append((writer, None))
+		else:
+			self.closeEntry(writer)
+
+	def dumpSegment(self, segment: Segment, path: str) -> None:
+		# case 0 has no decompressed size in the table, the buffer is sized for full chunks and trimmed on close
+		writer: BigArchive.EntryWriter = self.openWriter(path, sum(CHUNK_SIZE if chunk.flags & 0x10 else chunk.size for chunk in segment.chunks))
+		for chunk in segment.chunks:
+			self.queueChunk(writer, chunk, self.readAt(chunk.offset, chunk.size))
+		self.finishWriter(writer)
+
+	@staticmethod
+	def inflateChunk(chunk: Chunk, payload: bytes | memoryview) -> bytes | memoryview:
+		if chunk.flags & 0x10:
+			return zlib.decompress(payload, -15)
+		return payload
+
+	def flushPending(self, max_chunks: int = 0, max_bytes: int | None = None) -> None:
+		# chunks are written in the order they were queued, an entry is closed after its last chunk
+		while self.pending and (len(self.pending) > max_chunks or max_bytes is not None and self.pending_bytes > max_bytes):
+			(writer, future) = self.pending.popleft()
+			if future is None:
+				self.closeEntry(writer)
+				continue
+			writer.write(future.result())
+			self.pending_bytes -= CHUNK_SIZE
+
+	def processMulti(self, entry: Entry, skip: bool = False) -> None:
+		segment: BigArchive.Segment = self.readSegment(entry.offset)
+		print(f'\tType: {segment.type}')
+		print(f'\tNum chunks: {len(segment.chunks)}')
+		print(f'\tUnknown: {segment.u0} {segment.u1} {segment.u2} {segment.u3}')
+
+		self.manifest.writeSegment(2, entry, segment) #type: ignore
+
+		writer: BigArchive.EntryWriter | None = None if skip else self.openEntry(entry)
+
+		for i in range(len(segment.objects)):
+			uobj: int = segment.objects[i]
 
 			print(f'\tObject {i}:')
 			print(f'\t\tData: {uobj}')
-			ET.SubElement(entry_xml_segment, 'object').text = str(uobj)
 		print('')
 
-		for i in range(len(chunks)):
-			chunk: BigArchive.Chunk = chunks[i]
+		for i in range(len(segment.chunks)):
+			chunk: BigArchive.Chunk = segment.chunks[i]
 
 			print(f'\tChunk {i}:')
 			print(f'\t\tOffset: {chunk.offset}')
@@ -148,124 +718,98 @@ class BigArchive:
 			print(f'\t\tFlags: 0x{chunk.flags:02x}')
 			print(f'\t\tSize coeff: {chunk.size_coeff}')
 
-			# size & offset probably useless
-			entry_xml_chunk = ET.SubElement(entry_xml_segment, 'chunk', attrib={'flags': f'0x{chunk.flags:02x}', 'size_coefficient': f'{chunk.size_coeff}', 'size': f'{chunk.size}', 'offset': f'{chunk.offset}'}) #type: ignore
-
-			self.file.seek(chunk.offset)
-			if chunk.flags & 0x10:
-				data += zlib.decompress(self.file.read(chunk.size), -15)
-			else:
-				data += self.file.read(entry.size1) # chunk.size isnt used, since flag 0x00 assumes that the file smaller in size without compression.  
+			if writer is not None:
+				self.queueChunk(writer, chunk, self.readChunk(entry, chunk))
 
-		self.dumpEntry(entry, data)
+		if writer is not None:
+			self.finishWriter(writer)
 
 	def unpack(self) -> None:
-		global entry_xml_segments, entries_dir
-		entry_xml_segments = ET.SubElement(entry_xml_root, 'segments')
-
 		num_segments: int = 0
-		entries_dir = f'entries/{self.file_name}'
+		entries_dir: str = f'entries/{self.file_name}'
 		mkdirSafe(entries_dir)
+
+		(manifest_name, manifest_writer) = MANIFEST_WRITERS[self.manifest_format]
+		self.manifest = manifest_writer(f'{entries_dir}/{manifest_name}', self.endianness, self.file_name)
+		self.manifest.writeTable(self.archive_type, self.entries)
+
 		with open(f'{entries_dir}/entries.txt', 'w') as entries_list_file:
+			if self.jobs > 1:
+				self.pool = ThreadPoolExecutor(self.jobs)
+
 			if not self.entries:
-				offset: int = 0
-
-				while offset < self.file_table_offset:
-					self.file.seek(offset)
-
-					magic = unpack(self.endianness + 'I', self.file.read(calcsize(self.endianness + 'I')))[0]
-					self.file.seek(-calcsize(self.endianness + 'I'), os.SEEK_CUR)
-					if magic == unpack_from(b'>I', b'segs')[0]:
-						(_magic, type, num_chunks, u0, u1, u2, u3) = unpack(self.endianness + 'I2H4B', self.file.read(calcsize(self.endianness + 'I2H4B')))
-						print(f'\tType: {type}')
-						print(f'\tNum chunks: {num_chunks}')
-						print(f'\tUnknown: {u0} {u1} {u2} {u3}')
-						data_offset: int = align(self.file.tell() + u0 * calcsize(self.endianness + 'I') + num_chunks * calcsize(self.endianness + '2H'), 16)
-
-						# num_chunks, u1-u3 probably useless; 0 case indicates that the segment is proceed without a entries table. Without hash
-						entry_xml_segment = ET.SubElement(entry_xml_segments, 'segment', attrib={'case': '0', 'type': f'{type}', 'u0': f'{u0}', 'u1': f'{u1}', 'u2': f'{u2}', 'u3': f'{u3}'})
-
-						uobjs: list[int] = []
-						for _ in range(u0):
-							uobj = unpack(self.endianness + 'I', self.file.read(calcsize(self.endianness + 'I')))[0]
-							uobjs.append(uobj)
-
-						chunks: list[BigArchive.Chunk] = []
-						chunks_total_size: int = 0
-						for _ in range(num_chunks):
-							chunk = self.Chunk()
-
-							(chunk.size, chunk.flags, chunk.size_coeff) = unpack(self.endianness + 'H2B', self.file.read(calcsize(self.endianness + 'H2B')))
-
-							chunk.offset = data_offset
-							chunk.size += 0x10000 * chunk.size_coeff
-							chunks_total_size += chunk.size
-							data_offset += chunk.size
-							chunks.append(chunk)
-
-						data: bytes = b''
-
-						for i in range(len(uobjs)):
-							uobj: int = uobjs[i]
-
-							print(f'\tObject {i}:')
-							print(f'\t\tData: {uobj}')
-							ET.SubElement(entry_xml_segment, 'object').text = str(uobj)
-						print('')
-
-						for i in range(len(chunks)):
-							chunk: BigArchive.Chunk = chunks[i]
-
-							print(f'\tChunk {i}:')
-							print(f'\t\tOffset: {chunk.offset}')
-							print(f'\t\tSize: {chunk.size}')
-							print(f'\t\tFlags: 0x{chunk.flags:02x}')
-							print(f'\t\tSize coeff: {chunk.size_coeff}')
-
-							# size & offset probably useless
-							entry_xml_chunk = ET.SubElement(entry_xml_segment, 'chunk', attrib={'flags': f'0x{chunk.flags:02x}', 'size_coefficient': f'{chunk.size_coeff}', 'size': f'{chunk.size}', 'offset': f'{chunk.offset}'}) #type: ignore
-
-							self.file.seek(chunk.offset)
-							if chunk.flags & 0x10:
-								data += zlib.decompress(self.file.read(chunk.size), -15)
-							else:
-								data += self.file.read(chunk.size)
-						print(f'Total size: {chunks_total_size}')
-
-						entry_dir: str = f'segments/{self.file_name}'
-						mkdirSafe(entry_dir)
-						with open(f'{entry_dir}/{num_segments:06d}', 'wb') as fout:
-							fout.write(data)
-
-						while self.file.tell() + 16 < self.file_table_offset:
-							padding: bytes = self.file.read(16)
-							if padding != b'X' * 16 and padding != b'\x00' * 16:
-								self.file.seek(-16, os.SEEK_CUR)
-								break
-						offset = self.file.tell()
-
-						print(f'seg {num_segments}: {data_offset} -> {offset} ::: {offset - data_offset}')
-						num_segments += 1
-					else:
-						print('DAMN!!!!!!!!!!!!')
+				segments: list[BigArchive.Segment] = self.scanSegments()
+				segments_dir: str = f'segments/{self.file_name}'
+				mkdirSafe(segments_dir)
+
+				for num_segments in range(len(segments)):
+					segment: BigArchive.Segment = segments[num_segments]
+					print(f'\tType: {segment.type}')
+					print(f'\tNum chunks: {len(segment.chunks)}')
+					print(f'\tUnknown: {segment.u0} {segment.u1} {segment.u2} {segment.u3}')
+
+					# num_chunks, u1-u3 probably useless
+					self.manifest.writeSegment(0, None, segment)
+
+					chunks_total_size: int = sum(chunk.size for chunk in segment.chunks)
+					data_offset: int = self.segmentEnd(segment)
+
+					for i in range(len(segment.objects)):
+						uobj: int = segment.objects[i]
+
+						print(f'\tObject {i}:')
+						print(f'\t\tData: {uobj}')
+					print('')
+
+					for i in range(len(segment.chunks)):
+						chunk: BigArchive.Chunk = segment.chunks[i]
+
+						print(f'\tChunk {i}:')
+						print(f'\t\tOffset: {chunk.offset}')
+						print(f'\t\tSize: {chunk.size}')
+						print(f'\t\tFlags: 0x{chunk.flags:02x}')
+						print(f'\t\tSize coeff: {chunk.size_coeff}')
+					print(f'Total size: {chunks_total_size}')
+
+					# chunks are read in this thread and inflated by the pool, at most jobs * 4 of them are pending
+					self.dumpSegment(segment, f'{segments_dir}/{num_segments:06d}')
+
+					offset: int = segments[num_segments + 1].offset if num_segments + 1 < len(segments) else self.file_table_offset
+					if bytes(self.readAt(data_offset, offset - data_offset)).strip(b'X\x00'):
+						print(f'Unknown data between {data_offset} and {offset}')
+					print(f'seg {num_segments}: {data_offset} -> {offset} ::: {offset - data_offset}')
+
+				self.flushPending()
 				print('')
 
+			fingerprints: dict[str, dict[str, int | str]] = {}
+			num_skipped: int = 0
+			num_filtered: int = 0
+			if self.incremental:
+				self.loadFingerprints()
+
 			for i in range(len(self.entries)):
 				entry: BigArchive.Entry = self.entries[i]
 
 				entries_list_file.write(f'0x{entry.hash:08x}\n')
-				
-				self.file.seek(entry.offset)
-				magic: int = unpack(self.endianness + 'I', self.file.read(calcsize(self.endianness + 'I')))[0]
-				self.file.seek(-calcsize(self.endianness + 'I'), os.SEEK_CUR)
-				if magic == unpack_from(b'>I', b'segs')[0]:
+
+				# entries that do not match the filters are skipped like unchanged ones, their manifest records are still written
+				skip: bool = not self.matchesFilter(entry)
+				num_filtered += skip
+				if self.incremental and not skip:
+					# unchanged entries are not inflated again, their manifest records are still written
+					fingerprints[f'0x{entry.hash:08x}'] = self.fingerprint(entry)
+					skip = self.isUnchanged(entry, fingerprints[f'0x{entry.hash:08x}'])
+					num_skipped += skip
+
+				if self.isSegment(entry.offset):
 					print('processing multi...')
 					print(f'\tHash: 0x{entry.hash:08x}')
 					print(f'\tOffset: {entry.offset}')
 					print(f'\tSize1: {entry.size1}')
 					print(f'\tSize2: {entry.size2}')
 					print(f'\tSize3: {entry.size3}')
-					self.processMulti(entry)
+					self.processMulti(entry, skip)
 				else:
 					print('processing single...')
 					print(f'\tHash: 0x{entry.hash:08x}')
@@ -273,35 +817,243 @@ class BigArchive:
 					print(f'\tSize1: {entry.size1}')
 					print(f'\tSize2: {entry.size2}')
 					print(f'\tSize3: {entry.size3}')
-					self.processSingle(entry)
+					self.processSingle(entry, skip)
 				print('')
 
-def processFile(file_name: str) -> None:
-	global entry_xml_root
+			if self.pool:
+				self.flushPending()
+				self.pool.shutdown()
+				self.pool = None
 
-	endianness: str
+			if self.incremental:
+				self.saveFingerprints(fingerprints)
+				print(f'Skipped {num_skipped} unchanged entries of {len(self.entries)}')
+			if self.hash_filter is not None or self.magic_filter:
+				print(f'Skipped {num_filtered} entries that do not match the filters of {len(self.entries)}')
+
+		self.manifest.close()
+		self.manifest = None
+
+def getEndianness(file_name: str) -> str | None:
 	if file_name.endswith('.pc'):
-		endianness = '<'
+		return '<'
 	elif file_name.endswith('.ps3'):
-		endianness = '>'
+		return '>'
 	elif file_name.endswith('.360'):
 		print('Xbox 360 format is not supported for now')
-		return
 	else:
 		print('Unknown format')
-		return
+	return None
 
-	entry_xml_root = ET.Element('root', attrib={'endianness': endianness, 'file_name': os.path.basename(file_name)})
+def processFile(file_name: str, *, jobs: int = 1, use_mmap: bool = False, use_index: bool = False, stream: bool = False, memory_limit: int = 0, incremental: bool = False, manifest_format: str = 'xml', hash_filter: set[int] | None = None, magic_filter: list[bytes] | None = None) -> dict[str, Any]:
+	summary: dict[str, Any] = {'file': file_name, 'entries': 0, 'segments': 0, 'archive_size': 0, 'data_size': 0, 'seconds': 0.0, 'error': None}
+	start_time: float = time.perf_counter()
+	endianness = getEndianness(file_name)
+	if endianness is None:
+		summary['error'] = 'unknown format'
+		return summary
 
 	with open(file_name, 'rb') as file:
 		try:
-			arc = BigArchive(file, endianness, os.path.basename(file_name))
-			arc.unpack()
-			tree = ET.ElementTree(entry_xml_root)
-			tree.write(f'{entries_dir}/entries.xml')
+			arc = BigArchive(file, endianness, os.path.basename(file_name), jobs=jobs, use_mmap=use_mmap, use_index=use_index, stream=stream, memory_limit=memory_limit, incremental=incremental, manifest_format=manifest_format, hash_filter=hash_filter, magic_filter=magic_filter)
+			try:
+				arc.unpack()
+				summary['entries'] = len(arc.entries)
+				summary['segments'] = len(arc.scanned_segments or [])
+				summary['archive_size'] = arc.file_size
+				summary['data_size'] = sum(entry.size1 + entry.size2 for entry in arc.entries)
+			finally:
+				arc.close()
 		except EOFError:
 			print('Failed open file')
-			return
+			summary['error'] = 'failed open file'
+
+	summary['seconds'] = time.perf_counter() - start_time
+	return summary
+
+def processLogged(file_name: str, **options: Any) -> dict[str, Any]:
+	# in batch mode every archive writes its log to entries/<archive>/unpack.log, so the outputs of the processes are not mixed, options are the keyword arguments of processFile
+	entries_dir: str = f'entries/{os.path.basename(file_name)}'
+	mkdirSafe(entries_dir)
+	with open(f'{entries_dir}/unpack.log', 'w') as log_file, redirect_stdout(log_file):
+		try:
+			return processFile(file_name, **options)
+		except Exception as e:
+			print(f'Failed to unpack {file_name}: {e!r}')
+			return {'file': file_name, 'entries': 0, 'segments': 0, 'archive_size': 0, 'data_size': 0, 'seconds': 0.0, 'error': repr(e)}
+
+def processBatch(file_names: list[str], processes: int, **options: Any) -> list[dict[str, Any]]:
+	summaries: list[dict[str, Any]] = []
+	with ProcessPoolExecutor(processes) as executor:
+		futures: dict[Future[dict[str, Any]], str] = {executor.submit(processLogged, file_name, **options): file_name for file_name in file_names}
+		for future in as_completed(futures):
+			summary: dict[str, Any] = future.result()
+			print(f'{summary["file"]}: {summary["error"] or "done"} ({summary["seconds"]:.2f} s)')
+			summaries.append(summary)
+	return sorted(summaries, key=lambda summary: file_names.index(summary['file']))
+
+def printSummary(summaries: list[dict[str, Any]], seconds: float) -> None:
+	print(f'{"archive":<40}{"entries":>9}{"segments":>10}{"archive MB":>12}{"data MB":>10}{"seconds":>9}')
+	for summary in summaries:
+		print(f'{os.path.basename(summary["file"]):<40}{summary["entries"]:>9}{summary["segments"]:>10}{summary["archive_size"] / 2**20:>12.1f}{summary["data_size"] / 2**20:>10.1f}{summary["seconds"]:>9.2f}{"  " + summary["error"] if summary["error"] else ""}')
+
+	archive_size: int = sum(summary['archive_size'] for summary in summaries)
+	print(f'{"total":<40}{sum(summary["entries"] for summary in summaries):>9}{sum(summary["segments"] for summary in summaries):>10}{archive_size / 2**20:>12.1f}{sum(summary["data_size"] for summary in summaries) / 2**20:>10.1f}{seconds:>9.2f}')
+	print(f'{len(summaries)} archives, {sum(bool(summary["error"]) for summary in summaries)} failed, {archive_size / max(seconds, 1e-9) / 2**20:.1f} MB/s')
+
+def extractFile(file_name: str, hashes: list[int], use_mmap: bool = False, use_index: bool = False, stream: bool = False, memory_limit: int = 0) -> None:
+	endianness = getEndianness(file_name)
+	if endianness is None:
+		return
+
+	with open(file_name, 'rb') as file:
+		arc = BigArchive(file, endianness, os.path.basename(file_name), use_mmap=use_mmap, use_index=use_index, stream=stream, memory_limit=memory_limit)
+		try:
+			for entry_hash in hashes:
+				entry = arc.findEntry(entry_hash)
+				if entry is None:
+					print(f'0x{entry_hash:08x} not found')
+					continue
+				arc.extractEntry(entry)
+				print(f'0x{entry_hash:08x}: entries/{arc.file_name}/0x{entry_hash:08x}')
+		finally:
+			arc.close()
+
+def statsFile(file_name: str, use_mmap: bool = False, use_index: bool = False, top: int = 10) -> dict[str, Any] | None:
+	endianness = getEndianness(file_name)
+	if endianness is None:
+		return None
+
+	with open(file_name, 'rb') as file:
+		arc = BigArchive(file, endianness, os.path.basename(file_name), use_mmap=use_mmap, use_index=use_index)
+		try:
+			return arc.stats(top)
+		finally:
+			arc.close()
+
+def printStats(stats: dict[str, Any]) -> None:
+	def ratio(stored_size: int, size: int) -> str:
+		return f'{stored_size / size:.2%}' if size else '-'
+
+	print(f'{stats["file"]}: {stats["archive_size"]} bytes, type {stats["archive_type"]}, {stats["entries"]} entries')
+	print(f'\t{"":<10}{"count":>9}{"size":>14}{"stored":>14}{"ratio":>9}')
+	for kind in ('single', 'multi'):
+		group: dict[str, int] = stats[kind]
+		print(f'\t{kind:<10}{group["count"]:>9}{group["size"]:>14}{group["stored_size"]:>14}{ratio(group["stored_size"], group["size"]):>9}')
+	print(f'\t{"total":<10}{stats["entries"]:>9}{stats["size"]:>14}{stats["stored_size"]:>14}{ratio(stats["stored_size"], stats["size"]):>9}')
+	print(f'\tChunks: {stats["multi"]["chunks"]} ({stats["multi"]["stored_chunks"]} without compression), objects: {stats["multi"]["objects"]}, two blocks: {stats["multi"]["multiblock"]}')
+	if stats['case0_segments']:
+		print(f'\tSegments without table: {stats["case0_segments"]}, {stats["case0_stored_size"]} bytes')
+	if stats['largest']:
+		print('\tLargest entries:')
+		for entry in stats['largest']:
+			print(f'\t\t{entry["hash"]} {entry["type"]:<7}{entry["size"]:>12}{entry["stored_size"]:>12}')
+
+def importDictionaries(option: str) -> None:
+	# dictionaries.py is not part of the repository, it has to be placed next to the scripts
+	try:
+		import dictionaries
+	except ImportError as e:
+		print(f'dictionaries.py is needed for {option}, place it next to bigpc3_unpack.py ({e})')
+		sys.exit(1)
+
+def getPathHash(path: str) -> int:
+	importDictionaries('entry paths')
+	from additional_functions import get_path_hash # imported here, since additional_functions depends on dictionaries.py
+	return get_path_hash(path)
+
+def getHashFilter(hash_file: str | None, globs: list[str]) -> set[int] | None:
+	# hashes (0x5669ff3c, f.e. from entries.txt) or paths from the file, and the known paths matching the globs
+	if hash_file is None and not globs:
+		return None
+
+	hashes: set[int] = set()
+	if hash_file is not None:
+		with open(hash_file, 'r') as hashes_file:
+			for line in hashes_file:
+				line = line.strip()
+				if not line or line.startswith('#'):
+					continue
+				try: # only 0x lines are hashes, paths like "face" are valid hex too
+					hashes.add(int(line, 16) if line.lower().startswith('0x') else getPathHash(line))
+				except ValueError:
+					hashes.add(getPathHash(line))
+
+	if globs:
+		importDictionaries('--glob')
+		from dictionaries import FILE_FULLNAME_DICTIONARY
+		patterns: list[str] = [pattern.lower() for pattern in globs]
+		hashes.update(path_hash for (path_hash, path) in FILE_FULLNAME_DICTIONARY.items() if any(fnmatchcase(path.lower(), pattern) for pattern in patterns))
+	return hashes
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Unpack .big archives.')
+	subparsers = parser.add_subparsers(dest='command')
 
-mkdirSafe('segments')
-list(map(lambda x: processFile(x) if os.path.exists(x) else None, sys.argv[1:]))
+	unpack_parser = subparsers.add_parser('unpack', help='Unpack every entry of the archives (default).')
+	unpack_parser.add_argument('files', nargs='*', help='Paths to .big files.')
+	unpack_parser.add_argument('--jobs', type=int, default=1, help='Number of threads used to inflate chunks (1 = serial).')
+	unpack_parser.add_argument('--mmap', action='store_true', help='Read the archive through a memory-mapped view instead of seek/read calls.')
+	unpack_parser.add_argument('--index', action='store_true', help='Use (and build if missing or stale) the <archive>.idx sidecar index.')
+	unpack_parser.add_argument('--stream', action='store_true', help='Write every chunk to disk as soon as it is inflated.')
+	unpack_parser.add_argument('--manifest', choices=MANIFEST_WRITERS.keys(), default='xml', help='Manifest format: entries.xml or entries.jsonl (one line per entry).')
+	unpack_parser.add_argument('--incremental', action='store_true', help='Skip entries whose fingerprint (offset, sizes, digest of the stored data) matches the last unpack.')
+	unpack_parser.add_argument('--hash-file', default=None, help='Unpack only the entries listed in the file, one hash (f.e. 0x5669ff3c) or path per line.')
+	unpack_parser.add_argument('--glob', action='append', default=[], help='Unpack only the entries whose known path matches, f.e. "intermediate/chunks/attribute/*.atb.chunk".')
+	unpack_parser.add_argument('--magic', action='append', default=[], help='Unpack only the entries that start with the magic, f.e. "trM#".')
+	unpack_parser.add_argument('--processes', type=int, default=1, help='Number of archives unpacked at once in separate processes, each writes its log to entries/<archive>/unpack.log (0 = all cores).')
+	unpack_parser.add_argument('--max-memory', type=int, default=0, help='Memory ceiling in MiB for buffered entries and chunks in flight, larger entries are streamed (0 = unlimited).')
+
+	extract_parser = subparsers.add_parser('extract', help='Extract single entries by hash or path.')
+	extract_parser.add_argument('file', help='Path to .big file.')
+	extract_parser.add_argument('--hash', action='append', default=[], help='Entry hash, f.e. 0x5669ff3c.')
+	extract_parser.add_argument('--path', action='append', default=[], help='Entry path, f.e. intermediate/chunks/characters/dead_bodies/pt007_kenneth_temple.chunk.')
+	extract_parser.add_argument('--mmap', action='store_true', help='Read the archive through a memory-mapped view instead of seek/read calls.')
+	extract_parser.add_argument('--index', action='store_true', help='Use (and build if missing or stale) the <archive>.idx sidecar index.')
+	extract_parser.add_argument('--stream', action='store_true', help='Write every chunk to disk as soon as it is inflated.')
+	extract_parser.add_argument('--max-memory', type=int, default=0, help='Memory ceiling in MiB for buffered entries and chunks in flight, larger entries are streamed (0 = unlimited).')
+
+	stats_parser = subparsers.add_parser('stats', help='Print entry counts and sizes from the file table and segment headers, without decompressing.')
+	stats_parser.add_argument('files', nargs='+', help='Paths to .big files.')
+	stats_parser.add_argument('--json', action='store_true', help='Print JSON instead of a table.')
+	stats_parser.add_argument('--top', type=int, default=10, help='Number of the largest entries to list.')
+	stats_parser.add_argument('--mmap', action='store_true', help='Read the archive through a memory-mapped view instead of seek/read calls.')
+	stats_parser.add_argument('--index', action='store_true', help='Use (and build if missing or stale) the <archive>.idx sidecar index.')
+
+	argv: list[str] = sys.argv[1:]
+	if not argv or argv[0] not in subparsers.choices and argv[0] not in ('-h', '--help'):
+		argv.insert(0, 'unpack') # "bigpc3_unpack.py file.big.pc" is still supported
+	args = parser.parse_args(argv)
+
+	if args.command == 'stats':
+		all_stats: list[dict[str, Any]] = [stats for stats in (statsFile(x, args.mmap, args.index, args.top) for x in args.files) if stats is not None]
+		if args.json:
+			json.dump(all_stats, sys.stdout, indent=1)
+			print('')
+		else:
+			list(map(printStats, all_stats))
+	elif args.command == 'extract':
+		extractFile(args.file, [int(x, 16) for x in args.hash] + [getPathHash(x) for x in args.path], args.mmap, args.index, args.stream, args.max_memory << 20)
+	else:
+		mkdirSafe('segments')
+		file_names: list[str] = [x for x in args.files if os.path.exists(x)]
+		hash_filter: set[int] | None = getHashFilter(args.hash_file, args.glob)
+		magic_filter: list[bytes] | None = [magic.encode('latin-1') for magic in args.magic] or None
+		options: dict[str, Any] = {
+			'jobs': args.jobs,
+			'use_mmap': args.mmap,
+			'use_index': args.index,
+			'stream': args.stream,
+			'memory_limit': args.max_memory << 20,
+			'incremental': args.incremental,
+			'manifest_format': args.manifest,
+			'hash_filter': hash_filter,
+			'magic_filter': magic_filter
+		}
+		processes: int = args.processes or os.cpu_count() or 1
+		if processes > 1 and len(file_names) > 1:
+			start_time: float = time.perf_counter()
+			summaries = processBatch(file_names, min(processes, len(file_names)), **options)
+			printSummary(summaries, time.perf_counter() - start_time)
+		else:
+			list(map(lambda x: processFile(x, **options), file_names))
@@ -1,97 +1,163 @@
-from json import load
-from struct import pack
-from io import IOBase
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from io import BufferedWriter
+from json import dump, load
+from struct import Struct
 from typing import Any
+from zlib import crc32
 from os.path import join, getsize
+import os, sys
 
-JSON_FILE = "dump\\out\\out.wad.pc.json"
-FILES = "dump\\out\\files"
-
-WAD_ARCHIVE = "dump\\out\\out.wad.pc"
+from wad_unpack import BLOCK_SIZE, WadArchive, copy_payload
 
 HEADER: bytes = bytes.fromhex("57414401")
 
-class BinaryWriter():
-	_file: IOBase
-	_endian: str
+HEADER_STRUCT: Struct = Struct("<4sI") # magic, number of files
+ENTRY_STRUCT: Struct = Struct("<3I") # crc32, offset, size
+NAME_SIZE_STRUCT: Struct = Struct("<H")
+
+class WadWriter():
+	_file: BufferedWriter
+	_entries: list[tuple[str, int, str, int, int]] # name, crc32, path, offset and size of the payload
 
-	def __init__(self, file: IOBase) -> None:
+	def __init__(self, file: BufferedWriter) -> None:
 		self._file = file
-		self._endian = "@"
-
-	def set_endian(self, endian: str) -> None:
-		self._endian = endian
-
-	def tell(self) -> int:
-		return self._file.tell()
-
-	def write(self, format: str, data: Any) -> int | None:
-		self._file.write(pack(f"{self._endian}{format}", data))
-
-	def write_uint8(self, data: int) -> int | None:
-		return self.write("B", data)
-		
-	def write_int8(self, data: int) -> int | None:
-		return self.write("b", data)
-		
-	def write_uint16(self, data: int) -> int | None:
-		return self.write("H", data)
-		
-	def write_int16(self, data: int) -> int | None:
-		return self.write("h", data)
-
-	def write_uint32(self, data: int) -> int | None:
-		return self.write("I", data)
-		
-	def write_int32(self, data: int) -> int | None:
-		return self.write("i", data)
-		
-	def write_uint64(self, data: int) -> int | None:
-		return self.write("Q", data)
-		
-	def write_int64(self, data: int) -> int | None:
-		return self.write("q", data)
-
-	def write_float32(self, data: float) -> int | None:
-		return self.write("f", data)
-		
-	def write_float64(self, data: float) -> int | None:
-		return self.write("d", data)
-
-	def write_string(self, data: str) -> int | None:
-		self.write(f"{len(data)}s", data.encode())
-
-	def write_chunk(self, data: Any) -> int | None:
-		return self._file.write(data)
-
-
-with open(JSON_FILE, "r") as json_file:
-	archive_data = load(json_file)
-
-with open(WAD_ARCHIVE, "wb") as wad_file:
-	writer = BinaryWriter(wad_file)
-	
-	writer.write_string("WAD\x01")
-	writer.write_uint32(archive_data["num_files"])
-	
-	file_data = []
-	offset = 8 + archive_data["num_files"] * 12
-
-	for file_data in archive_data["files"]:
-		path: str = join(FILES, file_data["name"])
-		size: int = getsize(path)
-		file_data["offset"] = offset
-		file_data["size"] = size
-		writer.write_uint32(file_data["hash"])
-		writer.write_uint32(file_data["offset"])
-		writer.write_uint32(file_data["size"])
-		offset += size
-
-	for file_data in archive_data["files"]:
-		with open(join(FILES, file_data["name"]), "rb") as file:
-			writer.write_chunk(file.read())
-
-	for file_data in archive_data["files"]:
-		name = file_data["name"]
-		writer.write_uint16(len(name))
-		writer.write_string(name)
+		self._entries = []
+
+	def add_file(self, name: str, crc: int, path: str) -> None:
+		self._entries.append((name, crc, path, 0, getsize(path)))
+
+	def add_payload(self, name: str, crc: int, path: str, offset: int, size: int) -> None: # f.e. a file from another archive
+		self._entries.append((name, crc, path, offset, size))
+
+	def write(self) -> None:
+		# header and entry table are packed into one buffer, payloads are streamed, names table goes last
+		table = bytearray(HEADER_STRUCT.size + ENTRY_STRUCT.size * len(self._entries))
+		HEADER_STRUCT.pack_into(table, 0, HEADER, len(self._entries))
+
+		offset: int = len(table)
+		for index, (_name, crc, _path, _offset, size) in enumerate(self._entries):
+			ENTRY_STRUCT.pack_into(table, HEADER_STRUCT.size + ENTRY_STRUCT.size * index, crc, offset, size)
+			offset += size
+
+		self._file.write(table)
+
+		for _name, _crc, path, offset, size in self._entries:
+			with open(path, "rb") as file:
+				copy_payload(file, self._file, offset, size)
+
+		names = bytearray()
+		for name, _crc, _path, _offset, _size in self._entries:
+			encoded_name: bytes = name.encode()
+			names += NAME_SIZE_STRUCT.pack(len(encoded_name)) + encoded_name
+		self._file.write(names)
+
+def file_crc(path: str) -> int:
+	crc: int = 0
+	with open(path, "rb") as file:
+		while data := file.read(BLOCK_SIZE):
+			crc = crc32(data, crc)
+	return crc
+
+def pack_wad(json_path: str, files_path: str, wad_path: str, jobs: int = 1) -> None:
+	with open(json_path, "r") as json_file:
+		archive_data = load(json_file)
+
+	# crc32 is computed for the files without hash, zlib releases the GIL, so the files are hashed in parallel
+	missing_files: list[dict[str, Any]] = [file_data for file_data in archive_data["files"] if file_data.get("hash") is None]
+	if missing_files:
+		with ThreadPoolExecutor(jobs) as executor:
+			for file_data, crc in zip(missing_files, executor.map(file_crc, [join(files_path, file_data["name"]) for file_data in missing_files])):
+				file_data["hash"] = crc
+		print(f"Computed crc32 of {len(missing_files)} files")
+
+	with open(wad_path, "wb") as wad_file:
+		writer = WadWriter(wad_file)
+		for file_data in archive_data["files"]:
+			writer.add_file(file_data["name"], file_data["hash"], join(files_path, file_data["name"]))
+		writer.write()
+
+def directory_names(files_path: str) -> list[str]: # relative paths of all files with / separators, as they are stored in the archive
+	names: list[str] = []
+	for directory, _directories, file_names in os.walk(files_path):
+		for file_name in file_names:
+			names.append(os.path.relpath(join(directory, file_name), files_path).replace(os.sep, "/"))
+	return sorted(names)
+
+def update_wad(wad_path: str, files_path: str, output_path: str | None = None, jobs: int = 1) -> None:
+	# unchanged payloads are copied from the old archive, a file is unchanged if its size and mtime match the last update, or its size and crc32 match the table
+	output_path = output_path or wad_path
+	state: dict[str, list[int]] = {}
+	try:
+		with open(wad_path + ".state.json", "r") as state_file:
+			state_data: dict[str, Any] = load(state_file)
+		wad_stat = os.stat(wad_path)
+		if state_data.get("archive") == [wad_stat.st_size, wad_stat.st_mtime_ns]: # the state is ignored if the archive was replaced since the last update
+			state = state_data["files"]
+	except (OSError, ValueError, AttributeError, KeyError):
+		pass
+
+	new_state: dict[str, list[int]] = {}
+	copied_count: int = 0
+	with WadArchive(wad_path) as archive:
+		archive_names: dict[str, str] = {name.replace("\\", "/"): name for name in archive.list()}
+		names: list[str] = list(archive_names.values()) + [name for name in directory_names(files_path) if name not in archive_names]
+
+		files: list[tuple[str, str, dict[str, int] | None]] = [] # name, path and the old entry of every file that still exists
+		for name in names:
+			path: str = join(files_path, *name.replace("\\", "/").split("/"))
+			if not os.path.isfile(path):
+				continue
+			stat = os.stat(path)
+			new_state[name] = [stat.st_size, stat.st_mtime_ns]
+			entry: dict[str, int] | None = archive.entries_by_name.get(name)
+			files.append((name, path, entry if entry is not None and entry["size"] == stat.st_size else None))
+
+		# only the files without the same size and mtime as in the last update are read
+		unknown_files: list[tuple[str, str, dict[str, int] | None]] = [(name, path, entry) for name, path, entry in files if entry is None or state.get(name) != new_state[name]]
+		with ThreadPoolExecutor(jobs) as executor:
+			crcs: dict[str, int] = dict(zip((name for name, _path, _entry in unknown_files), executor.map(file_crc, [path for _name, path, _entry in unknown_files])))
+
+		temporary_path: str = output_path + ".tmp"
+		with open(temporary_path, "wb") as wad_file:
+			writer = WadWriter(wad_file)
+			for name, path, entry in files:
+				if entry is not None and crcs.get(name, entry["crc32"]) == entry["crc32"]:
+					writer.add_payload(name, entry["crc32"], wad_path, entry["offset"], entry["size"])
+					copied_count += 1
+				else:
+					writer.add_file(name, crcs[name], path)
+			writer.write()
+
+	os.replace(temporary_path, output_path)
+	output_stat = os.stat(output_path)
+	with open(output_path + ".state.json", "w") as state_file:
+		dump({"archive": [output_stat.st_size, output_stat.st_mtime_ns], "files": new_state}, state_file)
+
+	print(f"Copied {copied_count} unchanged files, wrote {len(files) - copied_count} new or changed files, removed {len(names) - len(files)} files")
+
+if __name__ == "__main__":
+	parser = ArgumentParser(description="Pack a directory into .wad archive.")
+	subparsers = parser.add_subparsers(dest="command")
+
+	pack_parser = subparsers.add_parser("pack", help="Pack the folder into a new archive (default).")
+	pack_parser.add_argument("json", help="JSON file with num_files and files (name and hash of every file).")
+	pack_parser.add_argument("files", help="Folder with the files.")
+	pack_parser.add_argument("output", help="Path to the .wad archive.")
+	pack_parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Number of threads used to compute crc32 of the files without hash (default: all cores).")
+
+	update_parser = subparsers.add_parser("update", help="Rebuild an archive from its modified folder, unchanged files are copied from the archive.")
+	update_parser.add_argument("archive", help="Path to the .wad archive.")
+	update_parser.add_argument("files", help="Folder with the files, f.e. entries/<archive> from wad_unpack.py.")
+	update_parser.add_argument("--output", default=None, help="Path to the new archive (default: replaces the archive).")
+	update_parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Number of threads used to compute crc32 of the changed files (default: all cores).")
+
+	argv: list[str] = sys.argv[1:]
+	if not argv or argv[0] not in subparsers.choices and argv[0] not in ("-h", "--help"):
+		argv.insert(0, "pack") # "wad_pack.py json files output" is still supported
+	args = parser.parse_args(argv)
+
+	if args.command == "update":
+		update_wad(args.archive, args.files, args.output, args.jobs)
+	else:
+		pack_wad(args.json, args.files, args.output, args.jobs)
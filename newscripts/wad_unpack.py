@@ -1,77 +1,228 @@
+from __future__ import annotations # WadArchive.list shadows list in the class body
 import os, sys
+import argparse
+import json
+import mmap
 import struct
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import BinaryIO
 
+BLOCK_SIZE: int = 2**20
+
+def copy_payload(file: BinaryIO, output_file: BinaryIO, offset: int, size: int, mapping: mmap.mmap | None = None) -> None:
+	# copies size bytes from offset to the current position of the output file, by the kernel if possible, otherwise from the mapping without reading it into a buffer, or in blocks
+	if hasattr(os, 'copy_file_range'):
+		output_file.flush()
+		try:
+			while size:
+				copied_size: int = os.copy_file_range(file.fileno(), output_file.fileno(), size, offset)
+				if not copied_size:
+					break
+				offset += copied_size
+				size -= copied_size
+		except OSError:
+			pass
+	if not size:
+		return
+
+	if mapping is not None:
+		with memoryview(mapping) as view:
+			output_file.write(view[offset:offset + size])
+		return
+	file.seek(offset)
+	while size and (data := file.read(min(size, BLOCK_SIZE))):
+		output_file.write(data)
+		size -= len(data)
+
+class WadArchive:
+	# parses the entry table and the names table once, files are read as slices of a memory-mapped view
+	def __init__(self, file_path: str, use_index: bool = False):
+		self.file_path = file_path
+		self.file = open(file_path, 'rb')
+		self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		self.view = memoryview(self.mapping)
+
+		self.entries: list[dict[str, int]] = []
+		self.names: list[str] = []
+		if not (use_index and self._load_index()):
+			self.entries, self.names = self._read_tables()
+			if use_index:
+				self._save_index()
+
+		self.entries_by_name: dict[str, dict[str, int]] = dict(zip(self.names, self.entries))
+		self.names_by_crc: dict[int, str] = {entry['crc32']: name for name, entry in zip(self.names, self.entries)}
+
+	def __enter__(self) -> 'WadArchive':
+		return self
+
+	def __exit__(self, *args) -> None:
+		self.close()
+
+	def close(self) -> None:
+		self.view.release()
+		self.mapping.close()
+		self.file.close()
+
+	def list(self) -> list[str]:
+		return list(self.names)
+
+	def entry(self, name: str) -> dict[str, int]:
+		return self.entries_by_name[name]
+
+	def open(self, name: str) -> memoryview:
+		# zero-copy, the view is valid until the archive is closed
+		entry = self.entries_by_name[name]
+		return self.view[entry['offset']:entry['offset'] + entry['size']]
+
+	def read(self, name: str) -> bytes:
+		return bytes(self.open(name))
+
+	def read_by_crc(self, crc: int) -> bytes:
+		return self.read(self.names_by_crc[crc])
+
+	def check_entry(self, index: int) -> bool:
+		# compares the crc32 of the payload with the value from the table
+		entry = self.entries[index]
+		with self.view[entry['offset']:entry['offset'] + entry['size']] as payload:
+			return zlib.crc32(payload) == entry['crc32']
+
+	def verify(self, jobs: int = 1) -> list[str]:
+		# zlib.crc32 releases the GIL, so the payloads are hashed in parallel
+		with ThreadPoolExecutor(jobs) as executor:
+			return [name for name, matches in zip(self.names, executor.map(self.check_entry, range(len(self.entries)))) if not matches]
+
+	def _index_path(self) -> str:
+		return self.file_path + '.idx'
+
+	def _load_index(self) -> bool:
+		# the index is only used if it was built from an archive of the same size and mtime
+		try:
+			with open(self._index_path(), 'r') as index_file:
+				index = json.load(index_file)
+		except (OSError, ValueError):
+			return False
+
+		stat = os.fstat(self.file.fileno())
+		if index.get('size') != stat.st_size or index.get('mtime') != stat.st_mtime_ns:
+			return False
+
+		for name, file_crc, file_offset, file_size in index['entries']:
+			self.names.append(name)
+			self.entries.append({'crc32': file_crc, 'offset': file_offset, 'size': file_size})
+		return True
+
+	def _save_index(self) -> None:
+		stat = os.fstat(self.file.fileno())
+		index = {
+			'size': stat.st_size,
+			'mtime': stat.st_mtime_ns,
+			'entries': [[name, entry['crc32'], entry['offset'], entry['size']] for name, entry in zip(self.names, self.entries)]
+		}
+		try:
+			with open(self._index_path(), 'w') as index_file:
+				json.dump(index, index_file)
+		except OSError as e:
+			print(f'Failed to write index {self._index_path()}: {e}')
+
+	def _read_tables(self) -> tuple[list[dict[str, int]], list[str]]:
+		# the entry table and the names table are parsed at once, the names table follows the data of the last file
+		(file_count,) = struct.unpack_from('<I', self.view, 4) # after magic bytes
+
+		files_information: list[dict[str, int]] = []
+		for file_crc, file_offset, file_size in struct.iter_unpack('<3I', self.view[8:8 + file_count * struct.calcsize('<3I')]):
+			file_information: dict[str, int] = {
+				'crc32': file_crc,
+				'offset': file_offset,
+				'size': file_size
+			}
+			files_information.append(file_information)
+
+		if not files_information:
+			return files_information, []
+
+		names: list[str] = []
+		names_offset: int = files_information[-1]['offset'] + files_information[-1]['size']
+		for _ in range(file_count):
+			(name_size,) = struct.unpack_from('<H', self.view, names_offset)
+			names_offset += struct.calcsize('<H')
+			names.append(str(self.view[names_offset:names_offset + name_size], 'utf-8'))
+			names_offset += name_size
+
+		return files_information, names
+
 class WadExtractor:
 	def __init__(self, file_path: str):
 		self.file_path = file_path
-		self.output_dir = 'entries\\' + os.path.basename(file_path) + '\\'
+		self.output_dir = os.path.join('entries', os.path.basename(file_path))
 		
 		if self.output_dir:
 			os.makedirs(self.output_dir, exist_ok=True)
 
-	def extract_files(self):
-		with open(self.file_path, 'rb') as file:
-			file.seek(4) # set cursor reader after magic bytes 
-			file_count = int.from_bytes(file.read(4), byteorder='little')
-
-			entries_information, names_table_offset = self._read_names_offset(file, file_count)
-
-			for entry in range(file_count):
-				_, entry_offset, entry_size = entries_information[entry].values()
-				file.seek(entry_offset)
-				entry_data = file.read(entry_size)
-
-				file.seek(names_table_offset)
-				entry_name_size = int.from_bytes(file.read(2), byteorder='little')
-				entry_name = file.read(entry_name_size).decode()
-				names_table_offset = file.tell()
-
+	def extract_files(self, names: list[str] | None = None, use_index: bool = False, verify: bool = False, jobs: int = 1) -> list[str]:
+		# with verify the crc32 values are checked in a thread pool while the files are copied, returns the names that do not match
+		checks: list[tuple[str, Future[bool]]] = []
+		with WadArchive(self.file_path, use_index) as archive, ThreadPoolExecutor(jobs) as executor:
+			for index, (entry_name, entry_information) in enumerate(zip(archive.names, archive.entries)):
+				if names is not None and entry_name not in names:
+					continue
 				print(entry_name)
 
-				output_file_path = self._sanitize_file_name(self.output_dir + entry_name)
-
-				with open(output_file_path, 'wb') as output_file:
-					output_file.write(entry_data)
-
-	def _read_names_offset(self, file: BinaryIO, file_count: int) -> tuple[list[dict[str, int]], int]:
-		file.seek(8 + 4 + (file_count - 1) * 12) # wad header + file crc + data offset for file
-		(element_offset, element_size) = struct.unpack('<2I', file.read(struct.calcsize('<2I')))
-		names_table_offset: int = element_offset + element_size
+				if verify:
+					checks.append((entry_name, executor.submit(archive.check_entry, index)))
 
-		file.seek(8)
-		files_information: list[dict[str, int]] = []
+				output_file_path = self._sanitize_file_name(os.path.join(self.output_dir, entry_name))
 
-		for file_num in range(file_count):
-			file_crc, file_offset, file_size = struct.unpack('<3I', file.read(struct.calcsize('<3I')))
-			
-			file_information: dict[str, int] = {
-				'crc32': file_crc,
-				'offset': file_offset,
-				'size': file_size
-			}
+				with open(output_file_path, 'wb') as output_file:
+					copy_payload(archive.file, output_file, entry_information['offset'], entry_information['size'], archive.mapping)
 
-			print(f'File {file_num} data on {file.tell():x}')
-			files_information.append(file_information)
+			mismatches: list[str] = [entry_name for entry_name, check in checks if not check.result()]
 
-		return files_information, names_table_offset
+		if verify:
+			print_mismatches(mismatches, len(checks))
+		return mismatches
 
 	@staticmethod
 	def _sanitize_file_name(file_name: str) -> str:
-		sanitized_name = file_name.replace('/', '\\')
+		sanitized_name = file_name.replace('/', os.sep).replace('\\', os.sep)
 		os.makedirs(os.path.dirname(sanitized_name), exist_ok=True)
 
 		return sanitized_name
 
+def print_mismatches(mismatches: list[str], file_count: int) -> None:
+	for entry_name in mismatches:
+		print(f'CRC mismatch: {entry_name}')
+	print(f'Verified {file_count} files, {len(mismatches)} mismatches')
+
 if __name__ == '__main__':
-	try:
-		file_path = sys.argv[1:][0]
-		if not os.path.exists(file_path):
-			raise Exception('Path does not exist')
-	except:
+	parser = argparse.ArgumentParser(description='Unpack .wad archives.')
+	parser.add_argument('file', nargs='?', help='Path to .wad file.')
+	parser.add_argument('--list', action='store_true', help='Print the names, crc32 values and sizes of the files instead of unpacking.')
+	parser.add_argument('--name', action='append', default=None, help='Unpack only the file with this name, can be repeated.')
+	parser.add_argument('--verify', action='store_true', help='Check the crc32 of every unpacked file.')
+	parser.add_argument('--check', action='store_true', help='Only check the crc32 of every file, nothing is unpacked.')
+	parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='Number of threads used to compute crc32 (default: all cores).')
+	parser.add_argument('--index', action='store_true', help='Use (and build if missing or stale) the <archive>.idx sidecar index.')
+	args = parser.parse_args()
+
+	file_path: str = args.file or ''
+	if not os.path.exists(file_path):
 		file_path = input('Path to folder: ')
 		if not os.path.exists(file_path):
 			raise Exception('Path does not exist')
 
-	extractor = WadExtractor(file_path)
-	extractor.extract_files()
+	if args.check:
+		with WadArchive(file_path, args.index) as archive:
+			mismatches: list[str] = archive.verify(args.jobs)
+			print_mismatches(mismatches, len(archive.entries))
+		sys.exit(1 if mismatches else 0)
+
+	if args.list:
+		with WadArchive(file_path, args.index) as archive:
+			for entry_name in archive.list():
+				entry_information = archive.entry(entry_name)
+				print(f'0x{entry_information["crc32"]:08x} {entry_information["size"]:>12} {entry_name}')
+	else:
+		extractor = WadExtractor(file_path)
+		if extractor.extract_files(args.name, args.index, args.verify, args.jobs):
+			sys.exit(1)